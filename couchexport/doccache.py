@@ -0,0 +1,126 @@
+import json
+import sqlite3
+import threading
+from dimagi.utils.chunked import chunked
+from dimagi.utils.couch.bulk import get_docs
+
+
+class DocCache(object):
+    """
+    An on-disk (SQLite) cache of couch docs keyed by (_id, _rev).
+
+    Fetching docs through the cache only asks couch for the current rev of
+    each id (from _all_docs) and downloads the docs whose rev isn't cached.
+    Once the cached docs take up more than `max_size` bytes the least
+    recently used ones are evicted.
+
+    `hits` and `misses` count the docs served from the cache and from couch.
+    """
+
+    default_max_size = 1024 * 1024 * 1024
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size or self.default_max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # the lock makes it safe to share with DocPrefetcher's threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                "id TEXT PRIMARY KEY, rev TEXT NOT NULL, doc BLOB NOT NULL, "
+                "size INTEGER NOT NULL, used INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS docs_used ON docs (used)")
+        self._size, self._used = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM docs"
+        ).fetchone()
+
+    def _get_revs(self, database, ids):
+        revs = {}
+        for row in database.view('_all_docs', keys=list(ids)):
+            value = row.get('value')
+            # missing and deleted docs have no current rev
+            if value and not value.get('deleted'):
+                revs[row['id']] = value['rev']
+        return revs
+
+    def _get_cached(self, revs):
+        cached = {}
+        ids = list(revs)
+        for chunk in chunked(ids, 500):
+            rows = self._db.execute(
+                "SELECT id, rev, doc FROM docs WHERE id IN (%s)" % ','.join('?' * len(chunk)),
+                chunk
+            )
+            for id, rev, doc in rows:
+                if revs[id] == rev:
+                    cached[id] = json.loads(doc)
+        return cached
+
+    def _touch(self, ids):
+        self._used += 1
+        self._db.executemany(
+            "UPDATE docs SET used = ? WHERE id = ?",
+            [(self._used, id) for id in ids]
+        )
+
+    def _store(self, docs):
+        self._used += 1
+        for doc in docs:
+            data = json.dumps(doc)
+            row = self._db.execute("SELECT size FROM docs WHERE id = ?", (doc['_id'],)).fetchone()
+            if row:
+                self._size -= row[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO docs (id, rev, doc, size, used) VALUES (?, ?, ?, ?, ?)",
+                (doc['_id'], doc['_rev'], data, len(data), self._used)
+            )
+            self._size += len(data)
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        evicted = []
+        for id, size in self._db.execute("SELECT id, size FROM docs ORDER BY used"):
+            evicted.append((id,))
+            self._size -= size
+            if self._size <= self.max_size:
+                break
+        self._db.executemany("DELETE FROM docs WHERE id = ?", evicted)
+
+    def get_docs(self, database, keys):
+        """
+        Same as dimagi.utils.couch.bulk.get_docs, but only fetches
+        docs from couch that aren't already cached at their current rev.
+        """
+        revs = self._get_revs(database, keys)
+        with self._lock:
+            cached = self._get_cached(revs)
+        missing = [id for id in keys if id in revs and id not in cached]
+        fetched = dict((doc['_id'], doc) for doc in get_docs(database, keys=missing)) \
+            if missing else {}
+        with self._lock, self._db:
+            self._touch(cached)
+            self._store(fetched.values())
+            self._evict()
+            self.hits += len(cached)
+            self.misses += len(fetched)
+
+        docs = []
+        for id in keys:
+            doc = cached.get(id) or fetched.get(id)
+            if doc is not None:
+                docs.append(doc)
+        return docs
+
+    def iter_docs(self, database, ids, chunksize=100):
+        for doc_ids in chunked(ids, chunksize):
+            for doc in self.get_docs(database, doc_ids):
+                yield doc
+
+    def close(self):
+        with self._lock:
+            self._db.close()
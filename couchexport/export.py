@@ -1,15 +1,20 @@
 import itertools
 from couchexport.exceptions import SchemaMismatchException,\
     UnsupportedExportFormat
-from couchexport.schema import extend_schema
+from couchexport.schema import extend_schema, infer_schema
+from couchexport.files import SpillFile
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from couchexport.models import ExportSchema, Format
 from dimagi.utils.mixins import UnicodeMixIn
 from dimagi.utils.couch.database import get_db, iter_docs
 from couchexport import writers
+from couchexport.prefetch import DocPrefetcher
+from couchexport.doccache import DocCache
 from soil import DownloadBase
 from dimagi.utils.decorators.memoized import memoized
-from couchexport.util import get_schema_index_view_keys, default_cleanup
+from couchexport.util import get_schema_index_view_keys, default_cleanup, SchemaIndexIds,\
+    get_export_date_range, SerializableFunction, CompiledFilter
 from datetime import datetime
 
 class ExportConfiguration(object):
@@ -19,24 +24,84 @@ class ExportConfiguration(object):
     """
 
     def __init__(self, database, schema_index, previous_export=None, filter=None,
-                 disable_checkpoints=False, cleanup_fn=default_cleanup):
+                 disable_checkpoints=False, cleanup_fn=default_cleanup, workers=1,
+                 prefetch_workers=None, prefetch_depth=None, single_pass=False,
+                 doc_cache=None):
         self.database = database
         if len(schema_index) > 2:
             schema_index = schema_index[0:2]
         self.schema_index = schema_index
         self.previous_export = previous_export
         self.filter = filter
+        # compiled once, so it can learn which of its functions to run first
+        self._include = filter.compile() if isinstance(filter, SerializableFunction) else filter
+        # the range of export dates the filter restricts docs to, if any,
+        # is pushed down into the schema_index query
+        self.export_date_range = get_export_date_range(filter)
         self.timestamp = datetime.utcnow()
         self.potentially_relevant_ids = self._potentially_relevant_ids()
         self.disable_checkpoints = disable_checkpoints
         self.cleanup_fn = cleanup_fn
+        # number of processes used to infer the schema
+        self.workers = workers
+        # if set, docs are fetched by this many background threads, up to
+        # prefetch_depth chunks ahead of the export
+        self.prefetch_workers = prefetch_workers if prefetch_workers is not None \
+            else getattr(settings, 'COUCHEXPORT_PREFETCH_WORKERS', 0)
+        self.prefetch_depth = prefetch_depth or \
+            getattr(settings, 'COUCHEXPORT_PREFETCH_DEPTH', 4)
+        self.prefetcher = None
+        # if set, the docs are read once, building the schema and spilling
+        # the ones to export to disk, instead of once for each
+        self.single_pass = single_pass
+        self._spilled_docs = None
+        # a DocCache to fetch the docs through. If none is passed in, one
+        # is opened from the settings while docs are being read, and closed
+        # again once they have been.
+        self._doc_cache = doc_cache
+        self._owns_doc_cache = False
+
+    @property
+    def doc_cache(self):
+        if self._doc_cache is None and getattr(settings, 'COUCHEXPORT_DOC_CACHE_PATH', None):
+            self._doc_cache = DocCache(
+                settings.COUCHEXPORT_DOC_CACHE_PATH,
+                max_size=getattr(settings, 'COUCHEXPORT_DOC_CACHE_MAX_SIZE', None),
+            )
+            self._owns_doc_cache = True
+        return self._doc_cache
+
+    def close(self):
+        """
+        Close the DocCache opened from the settings, if any
+        (one that was passed in is left to its owner)
+        """
+        if self._owns_doc_cache:
+            self._doc_cache.close()
+            self._doc_cache = None
+            self._owns_doc_cache = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def include(self, document):
         """
         Returns True if the document should be included in the results,
         otherwise false
         """
-        return self.filter(document) if self.filter else True
+        return self._include(document) if self._include else True
+
+    @property
+    def filter_stats(self):
+        """
+        What each of the filter's functions has cost and rejected so far,
+        if it's a SerializableFunction
+        """
+        if isinstance(self._include, CompiledFilter):
+            return self._include.get_stats()
 
     def cleanup(self, document_or_schema):
         """
@@ -52,20 +117,46 @@ class ExportConfiguration(object):
         """
         Gets view results for all documents matching this schema
         """
-        return set([result['id'] for result in \
-                    self.database.view(
-                        "couchexport/schema_index",
-                        reduce=False,
-                        **get_schema_index_view_keys(self.schema_index)
-                    ).all()])
+        return SchemaIndexIds(self.database, **get_schema_index_view_keys(self.schema_index))
 
     def _potentially_relevant_ids(self):
-        return self.previous_export.get_new_ids() if self.previous_export \
-            else self.all_doc_ids
+        if self.previous_export:
+            return self.previous_export.get_new_ids(date_range=self.export_date_range)
+        if self.export_date_range:
+            return SchemaIndexIds(self.database, **get_schema_index_view_keys(
+                self.schema_index, self.export_date_range))
+        return self.all_doc_ids
 
     def get_potentially_relevant_docs(self):
+        docs = self._get_potentially_relevant_docs()
+        try:
+            for doc in docs:
+                yield doc
+        finally:
+            # stop the prefetcher (which waits for its fetches to finish)
+            # before closing the cache it fetches through
+            if hasattr(docs, 'close'):
+                docs.close()
+            self.close()
+
+    def _get_potentially_relevant_docs(self):
+        if self.prefetch_workers:
+            self.prefetcher = DocPrefetcher(self.database, self.potentially_relevant_ids,
+                                            workers=self.prefetch_workers,
+                                            depth=self.prefetch_depth,
+                                            fetch=self.doc_cache.get_docs if self.doc_cache else None)
+            return iter(self.prefetcher)
+        if self.doc_cache:
+            return self.doc_cache.iter_docs(self.database, self.potentially_relevant_ids)
         return iter_docs(self.database, self.potentially_relevant_ids)
 
+    @property
+    def stall_times(self):
+        """
+        How long each stage of a pipelined export spent waiting on the other
+        """
+        return self.prefetcher.stall_times if self.prefetcher else None
+
     def enum_docs(self):
         """
         yields (index, doc) tuples for docs that pass the filter
@@ -76,6 +167,19 @@ class ExportConfiguration(object):
         len(self.potentially_relevant_ids) as the total.
 
         """
+        if self.single_pass:
+            self.get_latest_schema()
+        if self._spilled_docs is not None:
+            # the spilled docs are only read back once, so their file can go
+            # as soon as they have been (any later reads go to the database)
+            spilled_docs, self._spilled_docs = self._spilled_docs, None
+            try:
+                for i, doc in spilled_docs:
+                    yield i, doc
+            finally:
+                spilled_docs.close()
+            return
+
         for i, doc in enumerate(self.get_potentially_relevant_docs()):
             if self.include(doc):
                 yield i, self.cleanup(doc)
@@ -84,21 +188,89 @@ class ExportConfiguration(object):
         for _, doc in self.enum_docs():
             yield doc
 
+    def get_preview_docs(self, limit):
+        """
+        The first `limit` docs that pass the filter, fetched straight from
+        the schema_index view (include_docs) instead of by id.
+
+        With a filter, docs are fetched in larger pages, and only the first
+        COUCHEXPORT_PREVIEW_MAX_DOCS_SCANNED are looked at, so a selective
+        filter can give fewer than `limit`.
+        """
+        max_scanned = max(limit, getattr(settings, 'COUCHEXPORT_PREVIEW_MAX_DOCS_SCANNED', 1000))
+        page_size = limit
+        if self._include:
+            page_size = min(max_scanned, max(
+                limit, getattr(settings, 'COUCHEXPORT_PREVIEW_FILTERED_PAGE_SIZE', 100)
+            ))
+        scanned = itertools.islice(
+            self.potentially_relevant_ids.iter_docs(page_size=page_size), max_scanned
+        )
+        docs = (doc for doc in scanned if self.include(doc))
+        return [self.cleanup(doc) for doc in itertools.islice(docs, limit)]
+
+    def get_preview_schema(self, docs):
+        """
+        The last checkpoint's schema, extended in memory with the given
+        (cleaned up) docs. Unlike get_latest_schema, nothing else is read
+        and no checkpoint is created.
+        """
+        last_export = self.last_checkpoint()
+        schema = self.cleanup(dict(last_export.schema) if last_export else None)
+        for doc in docs:
+            schema = extend_schema(schema, doc)
+        return schema
+
     def last_checkpoint(self):
         return None if self.disable_checkpoints else ExportSchema.last(self.schema_index)
 
+    def _reads_all_new_docs(self, last_export):
+        """
+        Whether the docs being exported include every doc the latest schema
+        has to be extended with.
+        """
+        if self.export_date_range:
+            return False
+        if not self.previous_export:
+            return True
+        return last_export is not None and \
+            last_export.timestamp >= self.previous_export.timestamp
+
+    def _spill_docs(self, schema):
+        """
+        Read every potentially relevant doc once, extending the schema
+        with it and spilling it to disk for enum_docs if it is to be exported.
+        """
+        spilled_docs = SpillFile()
+        for i, doc in enumerate(self.get_potentially_relevant_docs()):
+            include = self.include(doc)
+            doc = self.cleanup(doc)
+            schema = extend_schema(schema, doc)
+            if include:
+                spilled_docs.write((i, doc))
+        self._spilled_docs = spilled_docs
+        return schema
+
     @memoized
     def get_latest_schema(self):
         last_export = self.last_checkpoint()
         schema = self.cleanup(dict(last_export.schema) if last_export else None)
+        if self.single_pass and self._reads_all_new_docs(last_export):
+            return self._spill_docs(schema)
+
         doc_ids = last_export.get_new_ids(self.database) if last_export else self.all_doc_ids
-        for doc in iter_docs(self.database, doc_ids):
-            schema = extend_schema(schema, self.cleanup(doc))
-        return schema
+        try:
+            # through the cache, so the docs it fetches are cached for enum_docs
+            return infer_schema(self.database, doc_ids, schema,
+                                cleanup_fn=self.cleanup_fn, workers=self.workers,
+                                doc_cache=self.doc_cache)
+        finally:
+            self.close()
 
     def create_new_checkpoint(self):
+        schema = self.get_latest_schema()
         checkpoint = ExportSchema(
-            schema=self.get_latest_schema(),
+            schema=schema,
             timestamp=self.timestamp,
             index=self.schema_index,
         )
@@ -108,17 +280,41 @@ class ExportConfiguration(object):
 
 def get_writer(format):
     try:
-        return {
-            Format.CSV: writers.CsvExportWriter,
+        writer_class = {
+            Format.CSV: writers.StreamingCsvExportWriter,
             Format.HTML: writers.HtmlExportWriter,
             Format.ZIPPED_HTML: writers.ZippedHtmlExportWriter,
-            Format.JSON: writers.JsonExportWriter,
+            Format.JSON: writers.StreamingJsonExportWriter,
+            Format.NDJSON: writers.NdjsonExportWriter,
             Format.XLS: writers.Excel2003ExportWriter,
-            Format.XLS_2007: writers.Excel2007ExportWriter,
+            Format.XLS_2007: writers.StreamingExcel2007ExportWriter,
             Format.UNZIPPED_CSV: writers.UnzippedCsvExportWriter,
-        }[format]()
+            Format.PARQUET: writers.ParquetExportWriter,
+            Format.ARROW: writers.ArrowExportWriter,
+            Format.SQLITE: writers.SqliteExportWriter,
+        }[format]
     except KeyError:
         raise UnsupportedExportFormat("Unsupported export format: %s!" % format)
+    # e.g. {Format.CSV: 0} to store csvs without compressing them
+    compression_levels = getattr(settings, 'COUCHEXPORT_COMPRESSION_LEVELS', {})
+    if format in compression_levels:
+        if not writer_class.accepts_compression_level:
+            raise ImproperlyConfigured(
+                "COUCHEXPORT_COMPRESSION_LEVELS sets a compression level for %s "
+                "exports, but %s doesn't compress its output"
+                % (format, writer_class.__name__)
+            )
+        return writer_class(compression_level=compression_levels[format])
+    return writer_class()
+
+def get_writer_for_formats(formats):
+    """
+    The writer for a single format, or one that writes all of them at once
+    (whose open() takes a file for each format)
+    """
+    if len(formats) == 1:
+        return get_writer(formats[0])
+    return writers.TeeExportWriter([get_writer(format) for format in formats])
 
 def export_from_tables(tables, file, format, max_column_size=2000):
     tables = FormattedRow.wrap_all_rows(tables)
@@ -166,7 +362,8 @@ def export_raw(headers, data, file, format=Format.XLS_2007,
     writer.close()
 
 
-def get_export_components(schema_index, previous_export_id=None, filter=None):
+def get_export_components(schema_index, previous_export_id=None, filter=None,
+                          single_pass=False):
     """
     Get all the components needed to build an export file.
     """
@@ -175,7 +372,7 @@ def get_export_components(schema_index, previous_export_id=None, filter=None):
         if previous_export_id else None
     database = get_db()
     config = ExportConfiguration(database, schema_index,
-        previous_export, filter)
+        previous_export, filter, single_pass=single_pass)
 
     # handle empty case
     if not config.potentially_relevant_ids:
@@ -265,11 +462,7 @@ def fit_to_schema(doc, schema):
         return doc
 
 def get_headers(schema, separator="|"):
-    return format_tables(
-        create_intermediate_tables(schema, schema),
-        include_data=False,
-        separator=separator,
-    )
+    return FlatteningPlan(schema, separator=separator).get_headers()
 
 def create_intermediate_tables(docs, schema):
     """
@@ -441,3 +634,242 @@ def format_tables(tables, id_label='id', separator='.', include_headers=True,
 
         answ.append((separator.join(table_name), new_table))
     return answ
+
+
+def _schema_mismatch(msg, doc):
+    raise SchemaMismatchException("doc-schema mismatch: %s (%s)" % (msg, doc))
+
+
+class _ScalarNode(object):
+    """
+    A "string" leaf of the schema, written to a single column of its table
+    """
+
+    def __init__(self):
+        self.slot = None
+
+    def fill(self, doc, row, id, tables):
+        if not doc:
+            doc = ""
+        if not isinstance(doc, basestring):
+            doc = unicode(doc)
+        row[self.slot] = doc
+
+    def fill_never_was(self, row):
+        row[self.slot] = scalar_never_was
+
+
+class _NullNode(_ScalarNode):
+    """
+    A leaf of the schema that has only ever been seen empty
+    """
+
+    def fill(self, doc, row, id, tables):
+        if doc:
+            _schema_mismatch("%s is not null" % doc, doc)
+        row[self.slot] = None
+
+
+class _UnknownNode(_ScalarNode):
+    """
+    A leaf with an unrecognized schema type, which fit_to_schema maps to None
+    """
+
+    def fill(self, doc, row, id, tables):
+        row[self.slot] = None
+
+
+class _DictNode(object):
+
+    def __init__(self, children, leaves, keys):
+        self.children = children
+        self.keys = frozenset(keys)
+        self.leaves = leaves
+        self.never_was_slots = ()
+
+    def fill(self, doc, row, id, tables):
+        if not doc:
+            return self.fill_never_was(row)
+        if not isinstance(doc, dict):
+            doc = {'': doc}
+        if not self.keys.issuperset(doc):
+            _schema_mismatch("doc has keys not in schema: '%s'" % (
+                "', '".join(set(doc) - self.keys)
+            ), doc)
+        for key, node in self.children:
+            if key in doc:
+                node.fill(doc[key], row, id, tables)
+            else:
+                node.fill_never_was(row)
+
+    def fill_never_was(self, row):
+        for slot in self.never_was_slots:
+            row[slot] = scalar_never_was
+
+
+class _ListNode(object):
+
+    def __init__(self, table):
+        self.table = table
+
+    def fill(self, doc, row, id, tables):
+        if not doc:
+            return
+        if not isinstance(doc, list):
+            doc = [doc]
+        table = self.table
+        for i, doc_ in enumerate(doc):
+            table.fill_row(doc_, id + (i,), tables)
+
+    def fill_never_was(self, row):
+        # a list that never was contributes no rows
+        pass
+
+
+class _PlanTable(object):
+
+    def __init__(self, path, depth, name):
+        self.path = path
+        self.depth = depth
+        self.name = name
+        self.columns = []
+        # the number of columns in the schema, selected or not
+        self.schema_width = 0
+        self.element = None
+        self.width = 0
+        self.position = None
+        self.separator = None
+
+    def fill_row(self, doc, id, tables):
+        if self.position is not None:
+            row = [None] * self.width
+            if self.element:
+                self.element.fill(doc, row, id, tables)
+            tables[self.position].append(FormattedRow(row, id, self.separator))
+        else:
+            self.element.fill(doc, None, id, tables)
+
+
+class FlatteningPlan(object):
+    """
+    A schema compiled once per export into the tables, sorted columns and
+    row ids that create_intermediate_tables + format_tables would produce
+    for it, so that each doc can be flattened in a single pass.
+
+    plan = FlatteningPlan(schema, separator='.')
+    plan.get_headers() == get_headers(schema, separator='.')
+    plan.flatten(doc) == format_tables(create_intermediate_tables(doc, schema), separator='.')
+
+    If `selection` ({table name: set of column names}) is given only those
+    tables and columns are flattened, and the parts of a doc that nothing
+    selected comes from are skipped entirely.
+    """
+
+    def __init__(self, schema, separator='.', id_label='id', selection=None):
+        self.schema = schema
+        self.separator = separator
+        self.id_label = id_label
+        self.selection = selection
+        self._all_tables = []
+        self._dict_nodes = []
+        self.root = self._compile([schema], None, ())
+        self._finalize()
+
+    def _is_selected(self, table, column=None):
+        if self.selection is None:
+            return True
+        if table.name not in self.selection:
+            return False
+        return column is None or self.separator.join(column) in self.selection[table.name]
+
+    def _compile(self, schema, table, column):
+        """
+        Build the node for the part of the schema found at `column` in `table`,
+        registering its leaves as columns of that table.
+
+        Returns None if nothing selected comes from that part of the schema.
+        """
+        if isinstance(schema, list):
+            schema_, = schema
+            path = table.path + column + ('#',) if table else ('#',)
+            child = _PlanTable(path, table.depth + 1 if table else 1, self.separator.join(path))
+            child.element = self._compile(schema_, child, ())
+            child.emits_rows = child.schema_width > 0 and self._is_selected(child)
+            if self.selection is not None and not child.element and not child.emits_rows:
+                return None
+            self._all_tables.append(child)
+            return _ListNode(child)
+
+        if isinstance(schema, dict):
+            children = []
+            leaves = []
+            for key in schema:
+                node = self._compile(schema[key], table, column + (key,))
+                if node is None:
+                    continue
+                children.append((key, node))
+                if isinstance(node, _ScalarNode):
+                    leaves.append(node)
+                elif isinstance(node, _DictNode):
+                    leaves.extend(node.leaves)
+            if self.selection is not None and not children:
+                return None
+            node = _DictNode(children, leaves, schema)
+            self._dict_nodes.append(node)
+            return node
+
+        table.schema_width += 1
+        if not self._is_selected(table, column):
+            return None
+        if schema is None:
+            node = _NullNode()
+        elif schema == "string":
+            node = _ScalarNode()
+        else:
+            node = _UnknownNode()
+        table.columns.append((column, node))
+        return node
+
+    def _finalize(self):
+        for table in self._all_tables:
+            table.columns.sort(key=lambda column_node: column_node[0])
+            for slot, (_, node) in enumerate(table.columns):
+                node.slot = slot
+            table.width = len(table.columns)
+            table.separator = self.separator
+        for node in self._dict_nodes:
+            node.never_was_slots = tuple(leaf.slot for leaf in node.leaves)
+
+        # tables without any columns never show up in an export
+        self.tables = sorted(
+            [table for table in self._all_tables if table.emits_rows],
+            key=lambda table: table.path
+        )
+        for position, table in enumerate(self.tables):
+            table.position = position
+            table.header_vals = [self.separator.join(column) for column, _ in table.columns]
+            table.id_key = [self.id_label]
+            if table.depth > 1:
+                table.id_key += ["{id}__{count}".format(id=self.id_label, count=i)
+                                 for i in range(table.depth)]
+
+    def _header_row(self, table):
+        return FormattedRow(list(table.header_vals), list(table.id_key),
+                            self.separator, is_header_row=True)
+
+    def get_headers(self):
+        if not self.schema:
+            return []
+        return [(table.name, [self._header_row(table)]) for table in self.tables]
+
+    def flatten(self, doc, include_headers=True):
+        tables = [[] for _ in self.tables]
+        if self.root:
+            self.root.fill(doc, None, (), tables)
+        answ = []
+        for table, rows in zip(self.tables, tables):
+            if rows:
+                if include_headers:
+                    rows.insert(0, self._header_row(table))
+                answ.append((table.name, rows))
+        return answ
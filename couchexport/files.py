@@ -1,3 +1,4 @@
+import cPickle
 import os
 import tempfile
 from dimagi.utils.decorators.memoized import memoized
@@ -48,6 +49,33 @@ class StringIOTemp(TempBase):
         if self._path is not None:
             os.remove(self._path)
 
+class SpillFile(object):
+    """
+    Pickles objects to an anonymous temp file so that they can be read
+    back, in the order they were written, once they have all been written.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self.count = 0
+
+    def write(self, obj):
+        cPickle.dump(obj, self._file, cPickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def __iter__(self):
+        self._file.flush()
+        self._file.seek(0)
+        for _ in xrange(self.count):
+            yield cPickle.load(self._file)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._file.close()
+
+
 class ExportFiles(object):
 
     def __init__(self, file, checkpoint, format=None):
@@ -1,6 +1,7 @@
 from couchexport.exceptions import SchemaMismatchException, ExportRebuildError
 from couchexport.models import GroupExportConfiguration, SavedBasicExport
 from couchdbkit.exceptions import ResourceNotFound
+from collections import OrderedDict
 from datetime import datetime
 import os
 import json
@@ -17,48 +18,88 @@ def export_for_group(export_id_or_group, output_dir, last_access_cutoff=None):
     else:
         config = export_id_or_group
 
-    for subconfig, schema in config.all_exports:
+    for subconfigs, schema in group_exports_by_schema(config.all_exports):
         try:
-            rebuild_export(subconfig, schema, output_dir, last_access_cutoff=last_access_cutoff)
+            rebuild_exports(subconfigs, schema, output_dir, last_access_cutoff=last_access_cutoff)
         except ExportRebuildError:
             continue
         except Exception, e:
             notify_exception(None, 'Problem building export {} in domain {}: {}'.format(
-                subconfig.index, getattr(config, 'domain', 'unknown'), e
+                subconfigs[0].index, getattr(config, 'domain', 'unknown'), e
             ))
 
 
+def group_exports_by_schema(exports):
+    """
+    Group (config, schema) pairs that export the same thing (in different
+    formats) into ([config, ...], schema) so they can be built together
+    """
+    groups = OrderedDict()
+    for config, schema in exports:
+        key = schema.get_id or json.dumps([schema.index, schema.type])
+        if key in groups:
+            groups[key][0].append(config)
+        else:
+            groups[key] = ([config], schema)
+    return groups.values()
+
+
 def rebuild_export(config, schema, output_dir, last_access_cutoff=None, filter=None):
+    rebuild_exports([config], schema, output_dir, last_access_cutoff=last_access_cutoff, filter=filter)
+
+
+def rebuild_exports(configs, schema, output_dir, last_access_cutoff=None, filter=None):
+    """
+    Rebuild the exports of a schema for each of the configs, writing
+    all of their formats from one pass over the docs.
+    """
     if output_dir == "couch":
-        saved = get_saved_export_and_delete_copies(config.index)
-        if last_access_cutoff and saved and saved.last_accessed and \
-                saved.last_accessed < last_access_cutoff:
-            # ignore exports that haven't been accessed since last_access_cutoff
+        configs = [config for config in configs
+                   if not _not_accessed_since(config, last_access_cutoff)]
+        if not configs:
             return
 
+    formats = list(OrderedDict.fromkeys(config.format for config in configs))
     try:
-        files = schema.get_export_files(format=config.format, filter=filter)
+        files_by_format = schema.get_multi_format_export_files(formats, filter=filter)
     except SchemaMismatchException:
         # fire off a delayed force update to prevent this from happening again
-        rebuild_schemas.delay(config.index)
-        raise ExportRebuildError(u'Schema mismatch for {}. Rebuilding tables...'.format(config.filename))
-
-    with files:
-        payload = files.file.payload
-        if output_dir == "couch":
-            if not saved:
-                saved = SavedBasicExport(configuration=config)
+        rebuild_schemas.delay(configs[0].index)
+        raise ExportRebuildError(u'Schema mismatch for {}. Rebuilding tables...'.format(
+            ', '.join(config.filename for config in configs)))
+
+    if not files_by_format:
+        return
+
+    try:
+        for config in configs:
+            payload = files_by_format[config.format].file.payload
+            if output_dir == "couch":
+                saved = get_saved_export_and_delete_copies(config.index)
+                if not saved:
+                    saved = SavedBasicExport(configuration=config)
+                else:
+                    saved.configuration = config
+
+                if saved.last_accessed is None:
+                    saved.last_accessed = datetime.utcnow()
+                saved.last_updated = datetime.utcnow()
+                saved.save()
+                saved.set_payload(payload)
             else:
-                saved.configuration = config
+                with open(os.path.join(output_dir, config.filename), "wb") as f:
+                    f.write(payload)
+    finally:
+        for files in files_by_format.values():
+            files.file.delete()
 
-            if saved.last_accessed is None:
-                saved.last_accessed = datetime.utcnow()
-            saved.last_updated = datetime.utcnow()
-            saved.save()
-            saved.set_payload(payload)
-        else:
-            with open(os.path.join(output_dir, config.filename), "wb") as f:
-                f.write(payload)
+
+def _not_accessed_since(config, last_access_cutoff):
+    # exports that haven't been accessed since last_access_cutoff are ignored
+    if not last_access_cutoff:
+        return False
+    saved = get_saved_export_and_delete_copies(config.index)
+    return saved and saved.last_accessed and saved.last_accessed < last_access_cutoff
 
 
 def get_saved_export_and_delete_copies(index):
@@ -0,0 +1,54 @@
+from optparse import make_option
+import timeit
+from django.core.management.base import BaseCommand
+from couchexport.properties import parse_date_string
+
+
+SAMPLES = [
+    '2015-05-14T13:03:06.455000Z',
+    '2014-10-07T12:27:15Z',
+    '2013-01-03T11:27:06+03:00',
+    'not a timestamp',
+]
+
+SETUP = """
+from dateutil.parser import parse
+from couchexport.properties import parse_date_string
+from couchexport.transforms import couch_to_excel_datetime, _couch_to_excel_datetime_strptime
+value = %r
+"""
+
+# (name, statement, whether it raises on values that aren't dates)
+BENCHMARKS = [
+    ('couch_to_excel_datetime', 'couch_to_excel_datetime(value, None)', False),
+    ('  strptime (previous)', '_couch_to_excel_datetime_strptime(value, None)', False),
+    ('parse_date_string', 'parse_date_string(value, True)', True),
+    ('  dateutil (previous)', 'parse(value).replace(tzinfo=None)', True),
+]
+
+
+class Command(BaseCommand):
+    help = "Times the couch timestamp parsing used by exports against the " \
+           "strptime/dateutil parsing it replaces."
+
+    option_list = BaseCommand.option_list + \
+        (make_option('--number', action='store', type='int', dest='number', default=20000,
+            help="Number of times to parse each value"),)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        for value in SAMPLES:
+            print value
+            for name, stmt, raises in BENCHMARKS:
+                if raises and not _parses(value):
+                    continue
+                seconds = min(timeit.repeat(stmt, SETUP % value, number=number, repeat=3))
+                print "  %-28s %6.2f us" % (name, seconds / number * 1e6)
+
+
+def _parses(value):
+    try:
+        parse_date_string(value)
+    except ValueError:
+        return False
+    return True
@@ -2,6 +2,7 @@ from django.core.management.base import LabelCommand, CommandError
 from couchexport.models import ExportSchema
 import json
 from couchexport.tasks import rebuild_schemas
+from optparse import make_option
 
 class Command(LabelCommand):
     help = "Given a particular export index, update all checkpoints " \
@@ -9,6 +10,10 @@ class Command(LabelCommand):
     args = "<index>"
     label = "Index of the export to use, or 'all' to include all exports"
 
+    option_list = LabelCommand.option_list + \
+        (make_option('--workers', action='store', type='int', dest='workers', default=1,
+            help="Number of processes to use when rebuilding each schema"),)
+
     def handle(self, *args, **options):
         if len(args) < 1: raise CommandError('Please specify %s.' % self.label)
         index_in = args[0]
@@ -18,5 +23,5 @@ class Command(LabelCommand):
             to_update = [json.loads(index_in)]
 
         for index in to_update:
-            processed = rebuild_schemas(index)
+            processed = rebuild_schemas(index, workers=options['workers'])
             print "processed %s checkpoints matching %s" % (processed, index)
@@ -12,9 +12,10 @@ import json
 import couchexport
 from couchexport.exceptions import CustomExportValidationError
 from couchexport.files import ExportFiles
-from couchexport.transforms import identity
+from couchexport.transforms import identity, is_value_pure, get_transform_many
 from couchexport.util import SerializableFunctionProperty,\
-    get_schema_index_view_keys, force_tag_to_list
+    get_schema_index_view_keys, SchemaIndexIds, intersect_date_ranges, LRUCache
+from django.conf import settings
 from dimagi.utils.decorators.memoized import memoized
 from dimagi.utils.mixins import UnicodeMixIn
 from dimagi.utils.couch.database import get_db, iter_docs
@@ -43,6 +44,29 @@ class register_column_type(object):
         return cls
 
 
+class _TempFiles(object):
+    """
+    Temporary files to write exports to: `file` is the only
+    one if there's one, otherwise the list of them.
+    """
+
+    def __init__(self, count):
+        self.paths = []
+        self.files = []
+        for _ in range(count):
+            fd, path = tempfile.mkstemp()
+            self.paths.append(path)
+            self.files.append(os.fdopen(fd, 'wb'))
+        self.file = self.files[0] if count == 1 else self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for file in self.files:
+            file.close()
+
+
 class Format(object):
     """
     Supported formats go here.
@@ -55,6 +79,10 @@ class Format(object):
     ZIPPED_HTML = "zipped-html"
     JSON = "json"
     UNZIPPED_CSV = 'unzipped-csv'
+    NDJSON = "ndjson"
+    PARQUET = "parquet"
+    ARROW = "arrow"
+    SQLITE = "sqlite"
 
     FORMAT_DICT = {CSV: {"mimetype": "application/zip",
                          "extension": "zip",
@@ -80,6 +108,18 @@ class Format(object):
                    UNZIPPED_CSV: {"mimetype": "text/csv",
                                   "extension": "csv",
                                   "download": True},
+                   NDJSON: {"mimetype": "application/x-ndjson",
+                            "extension": "ndjson",
+                            "download": True},
+                   PARQUET: {"mimetype": "application/zip",
+                             "extension": "zip",
+                             "download": True},
+                   ARROW: {"mimetype": "application/zip",
+                           "extension": "zip",
+                           "download": True},
+                   SQLITE: {"mimetype": "application/x-sqlite3",
+                            "extension": "sqlite",
+                            "download": True},
 
     }
 
@@ -172,24 +212,13 @@ class ExportSchema(Document, UnicodeMixIn):
 
     def get_all_ids(self, database=None):
         database = database or self.get_db()
-        return set(
-            [result['id'] for result in database.view(
-                        "couchexport/schema_index",
-                        reduce=False,
-                        **get_schema_index_view_keys(self.index)).all()])
+        return SchemaIndexIds(database, **get_schema_index_view_keys(self.index))
 
-    def get_new_ids(self, database=None):
+    def get_new_ids(self, database=None, date_range=None):
         database = database or self.get_db()
         assert self.timestamp, 'exports without timestamps are no longer supported.'
-        tag_as_list = force_tag_to_list(self.index)
-        startkey = tag_as_list + [self.timestamp.isoformat()]
-        endkey = tag_as_list + [{}]
-        return set(
-            [result['id'] for result in database.view(
-                        "couchexport/schema_index",
-                        reduce=False,
-                        startkey=startkey,
-                        endkey=endkey)])
+        date_range = intersect_date_ranges(filter(None, [(self.timestamp, None), date_range]))
+        return SchemaIndexIds(database, **get_schema_index_view_keys(self.index, date_range))
 
     def get_new_docs(self, database=None):
         return iter_docs(self.get_new_ids(database))
@@ -261,6 +290,13 @@ class ComplexExportColumn(ExportColumn):
         """
         raise NotImplementedError()
 
+    def get_data_function(self):
+        """
+        A function equivalent to get_data, for getting the data of many
+        values. Subclasses can precompute whatever get_data needs here.
+        """
+        return self.get_data
+
 
 @register_column_type('multi-select')
 class SplitColumn(ComplexExportColumn):
@@ -299,28 +335,54 @@ class SplitColumn(ComplexExportColumn):
             )
 
     def get_data(self, value):
-        from couchexport.export import Constant
+        return self.get_data_function()(value)
 
-        opts_len = len(self.options)
-        if isinstance(value, Constant):
-            row = [value] * opts_len
-        else:
-            row = [None] * opts_len
+    def get_data_function(self):
+        key = (tuple(self.options), self.ignore_extras)
+        if getattr(self, '_get_data_key', None) != key:
+            self._get_data = self._compile_get_data(*key)
+            self._get_data_key = key
+        return self._get_data
 
-        if not isinstance(value, basestring):
-            return row if self.ignore_extras else row + [value]
+    @staticmethod
+    def _compile_get_data(options, ignore_extras):
+        from couchexport.export import Constant
 
-        values = value.split(' ') if value else []
-        for index, option in enumerate(self.options):
-            if option in values:
-                row[index] = 1
-                values.remove(option)
+        opts_len = len(options)
+        # the columns of each option, in order, in case it's listed more than once
+        option_indexes = {}
+        for index, option in enumerate(options):
+            option_indexes.setdefault(option, []).append(index)
 
-        if self.ignore_extras:
-            return row
-        else:
-            remainder = ' '.join(values) if values else None
-            return row + [remainder]
+        def get_data(value):
+            if isinstance(value, Constant):
+                row = [value] * opts_len
+            else:
+                row = [None] * opts_len
+
+            if not isinstance(value, basestring):
+                return row if ignore_extras else row + [value]
+
+            # each occurrence of an option fills its next column,
+            # and the tokens that don't fill one are extras
+            extras = []
+            found = {}
+            for token in value.split(' ') if value else ():
+                indexes = option_indexes.get(token)
+                if indexes:
+                    count = found.get(token, 0)
+                    if count < len(indexes):
+                        row[indexes[count]] = 1
+                        found[token] = count + 1
+                        continue
+                extras.append(token)
+
+            if ignore_extras:
+                return row
+            else:
+                remainder = ' '.join(extras) if extras else None
+                return row + [remainder]
+        return get_data
 
     def to_config_format(self, selected=True):
         config = super(SplitColumn, self).to_config_format(selected)
@@ -413,36 +475,254 @@ class ExportTable(DocumentSchema):
             else:
                 yield column, val
 
-    def trim(self, data, doc, apply_transforms, global_transform):
-        from couchexport.export import FormattedRow, Constant, transform_error_constant
+    def get_projection_plan(self, headers, apply_transforms, global_transform):
+        """
+        The TableProjectionPlan for trimming rows with these headers.
+        Compile it once per export and pass it to every trim() call.
+        """
+        return TableProjectionPlan(self, tuple(headers), apply_transforms, global_transform)
+
+    def trim(self, data, doc, apply_transforms, global_transform, plan=None):
+        """
+        `plan` is this table's get_projection_plan() for the export;
+        without one a plan is compiled just for these rows.
+        """
+        from couchexport.export import FormattedRow
         if not hasattr(self, '_headers'):
             self._headers = tuple(data[0].get_data())
+        if plan is None:
+            plan = self.get_projection_plan(self._headers, apply_transforms, global_transform)
 
         # skip first element without copying
-        data = islice(data, 1, None)
+        data = list(islice(data, 1, None))
 
-        for row in data:
-            id = None
-            cells = []
-            for column, val in self.get_items_in_order(row):
-                # TRANSFORM BABY!
-                if apply_transforms:
-                    if column.transform and not isinstance(val, Constant):
-                        try:
-                            val = column.transform(val, doc)
-                        except Exception:
-                            val = transform_error_constant
-                    elif global_transform:
-                        val = global_transform(val, doc)
-
-                if column.index == 'id':
-                    id = val
-                else:
-                    cells.append(val)
+        projected = plan.project_rows([list(row.get_data()) for row in data], doc)
+        for row, (cells, id) in zip(data, projected):
             id_index = self.id_index if id else 0
             row_id = row.id if id else None
             yield FormattedRow(cells, row_id, id_index=id_index)
 
+
+class TableProjectionPlan(object):
+    """
+    What ExportTable.trim does to each row, worked out once for the table's
+    headers: where each column's value comes from, whether it's split into
+    several columns and the transform (if any) that's applied to it.
+
+    project() then just gathers the cells of a row.
+    """
+    transform_cache_size = getattr(settings, 'COUCHEXPORT_TRANSFORM_CACHE_SIZE', 10000)
+
+    def __init__(self, table, headers, apply_transforms, global_transform):
+        positions = dict((h, i) for i, h in enumerate(headers) if h in table.displays_by_index)
+        self.slots = []
+        for column in table.columns:
+            self.slots.append((
+                positions.get(column.index),
+                column.get_data_function() if issubclass(type(column), ComplexExportColumn) else None,
+                self._get_transform(column, apply_transforms, global_transform),
+                column.index == 'id',
+            ))
+        # the common case: every column is a plain value from the row
+        self.gather_indices = None
+        if all(i is not None and not split and not transform and not is_id
+               for i, split, transform, is_id in self.slots):
+            self.gather_indices = [i for i, _, _, _ in self.slots]
+        self.has_transform_many = any(
+            transform and transform.transform_many for _, _, transform, _ in self.slots
+        )
+
+    @classmethod
+    def _get_transform(cls, column, apply_transforms, global_transform):
+        if not apply_transforms:
+            return None
+        if global_transform is identity:
+            global_transform = None
+        if not column.transform and not global_transform:
+            return None
+        return ColumnTransform(column.transform, global_transform, cls.transform_cache_size)
+
+    def project(self, row_data, doc):
+        """
+        Returns the row's cells and its id (the value of its 'id' column, if any)
+        """
+        if self.gather_indices is not None:
+            return [row_data[i] for i in self.gather_indices], None
+
+        id = None
+        cells = []
+        for i, split, transform, is_id in self.slots:
+            val = row_data[i] if i is not None else ''
+            for val in (split(val) if split else (val,)):
+                if transform:
+                    val = transform(val, doc)
+                if is_id:
+                    id = val
+                else:
+                    cells.append(val)
+        return cells, id
+
+    def project_rows(self, rows, doc):
+        """
+        project() for each of a doc's rows in the table, transforming each
+        column's values in one go for transforms that have a batch version
+        """
+        if not self.has_transform_many:
+            return [self.project(row_data, doc) for row_data in rows]
+
+        columns = []
+        for i, split, transform, is_id in self.slots:
+            vals = [row_data[i] if i is not None else '' for row_data in rows]
+            if split:
+                parts = [list(split(val)) for val in vals]
+            else:
+                parts = [[val] for val in vals]
+            if transform:
+                flat = transform.transform_all(
+                    [val for row_parts in parts for val in row_parts], doc
+                )
+                position = 0
+                for row_parts in parts:
+                    row_parts[:] = flat[position:position + len(row_parts)]
+                    position += len(row_parts)
+            columns.append((is_id, parts))
+
+        projected = []
+        for r in range(len(rows)):
+            id = None
+            cells = []
+            for is_id, parts in columns:
+                for val in parts[r]:
+                    if is_id:
+                        id = val
+                    else:
+                        cells.append(val)
+            projected.append((cells, id))
+        return projected
+
+
+_missing = object()
+
+
+class ColumnTransform(object):
+    """
+    A column's transform as ExportTable.trim applies it: Constants only get
+    the global transform, and a value the column's transform fails on
+    becomes transform_error_constant. With no column transform, it's just the
+    global transform.
+
+    The results of value_pure transforms are remembered in an LRU cache of
+    `cache_size` values, and transforms with a batch_transform are given
+    all of the values transform_all() is called with at once.
+
+    Looking a value up costs about as much as a cheap transform, so the
+    cache is dropped for good after any `cache_window` lookups that found
+    fewer than `min_cache_hit_rate` of their values in it.
+    """
+    cache_window = 1000
+    min_cache_hit_rate = 0.5
+
+    def __init__(self, column_transform, global_transform, cache_size=None):
+        self.column_transform = column_transform
+        self.global_transform = global_transform
+        if column_transform:
+            pure = is_value_pure(column_transform)
+            self.transform_many = get_transform_many(column_transform)
+        else:
+            pure = is_value_pure(global_transform)
+            self.transform_many = get_transform_many(global_transform)
+        self.cache = LRUCache(cache_size) if pure and cache_size else None
+        self._lookups = 0
+        self._hits = 0
+
+    def _apply(self, val, doc):
+        from couchexport.export import transform_error_constant
+        if not self.column_transform:
+            return self.global_transform(val, doc)
+        try:
+            return self.column_transform(val, doc)
+        except Exception:
+            return transform_error_constant
+
+    def _is_constant(self, val):
+        from couchexport.export import Constant
+        return self.column_transform and isinstance(val, Constant)
+
+    def _apply_to_constant(self, val, doc):
+        return self.global_transform(val, doc) if self.global_transform else val
+
+    def _get_key(self, val):
+        key = (type(val), val)
+        hash(key)
+        return key
+
+    def _get_cached(self, key):
+        result = self.cache.get(key, _missing)
+        if result is not _missing:
+            self._hits += 1
+        self._lookups += 1
+        if self._lookups == self.cache_window:
+            if self._hits < self.cache_window * self.min_cache_hit_rate:
+                self.cache = None
+            self._lookups = self._hits = 0
+        return result
+
+    def __call__(self, val, doc):
+        if self._is_constant(val):
+            return self._apply_to_constant(val, doc)
+        if self.cache is None:
+            return self._apply(val, doc)
+        try:
+            key = self._get_key(val)
+        except TypeError:
+            return self._apply(val, doc)
+        result = self._get_cached(key)
+        if result is _missing:
+            result = self._apply(val, doc)
+            if self.cache is not None:
+                self.cache[key] = result
+        return result
+
+    def transform_all(self, vals, doc):
+        """
+        The transformed vals, the same as calling the transform on each
+        """
+        if not self.transform_many:
+            return [self(val, doc) for val in vals]
+
+        results = list(vals)
+        pending = []
+        for position, val in enumerate(vals):
+            if self._is_constant(val):
+                results[position] = self._apply_to_constant(val, doc)
+                continue
+            if self.cache is not None:
+                try:
+                    result = self._get_cached(self._get_key(val))
+                except TypeError:
+                    result = _missing
+                if result is not _missing:
+                    results[position] = result
+                    continue
+            pending.append(position)
+
+        if pending:
+            pending_vals = [vals[position] for position in pending]
+            try:
+                transformed = self.transform_many(pending_vals, doc)
+            except Exception:
+                # fall back to finding out which values it fails on
+                transformed = [self._apply(val, doc) for val in pending_vals]
+            for position, val, result in zip(pending, pending_vals, transformed):
+                results[position] = result
+                if self.cache is not None:
+                    try:
+                        self.cache[self._get_key(val)] = result
+                    except TypeError:
+                        pass
+        return results
+
+
 class BaseSavedExportSchema(Document):
     # signature: filter(doc)
     filter_function = SerializableFunctionProperty()
@@ -507,15 +787,16 @@ class FakeSavedExportSchema(BaseSavedExportSchema):
         # can be overridden to rename/remove default stuff from exports
         return tables
 
-    def get_export_components(self, previous_export_id=None, filter=None):
+    def get_export_components(self, previous_export_id=None, filter=None, single_pass=False):
         from couchexport.export import get_export_components
-        return get_export_components(self.index, previous_export_id, filter=self.filter & filter)
+        return get_export_components(self.index, previous_export_id, filter=self.filter & filter,
+                                     single_pass=single_pass)
 
     def get_export_files(self, format='', previous_export_id=None, filter=None,
-                         use_cache=True, max_column_size=2000, separator='|', process=None, **kwargs):
+                         use_cache=True, max_column_size=2000, separator='|', process=None,
+                         single_pass=False, **kwargs):
         # the APIs of how these methods are broken down suck, but at least
         # it's DRY
-        from couchexport.export import get_writer, format_tables, create_intermediate_tables, get_export_components, get_headers
         from django.core.cache import cache
         import hashlib
 
@@ -536,17 +817,53 @@ class FakeSavedExportSchema(BaseSavedExportSchema):
                 (tmp, checkpoint) = cached_data
                 return ExportFiles(tmp, checkpoint)
 
-        fd, path = tempfile.mkstemp()
-        with os.fdopen(fd, 'wb') as tmp:
-            schema_index = export_tag
+        paths, checkpoint = self._write_export_files(
+            [format], previous_export_id, filter, max_column_size=max_column_size,
+            separator=separator, process=process, single_pass=single_pass
+        )
+        path, = paths
+
+        if checkpoint:
+            if use_cache:
+                cache.set(cache_key, (path, checkpoint), CACHE_TIME)
+            return ExportFiles(path, checkpoint)
+
+        return None
+
+    def get_multi_format_export_files(self, formats, previous_export_id=None, filter=None,
+                                      max_column_size=2000, separator='|', process=None,
+                                      single_pass=False):
+        """
+        Like get_export_files, but writes the export in each of the formats
+        from one pass over the docs and returns {format: ExportFiles}
+        """
+        paths, checkpoint = self._write_export_files(
+            formats, previous_export_id, filter, max_column_size=max_column_size,
+            separator=separator, process=process, single_pass=single_pass
+        )
+        if checkpoint:
+            return dict((format, ExportFiles(path, checkpoint, format))
+                        for format, path in zip(formats, paths))
+
+        return None
+
+    def _write_export_files(self, formats, previous_export_id, filter, max_column_size,
+                            separator, process, single_pass):
+        from couchexport.export import get_writer_for_formats, get_export_components, FlatteningPlan
+
+        with _TempFiles(len(formats)) as tmp:
+            schema_index = self.index
             config, updated_schema, export_schema_checkpoint = get_export_components(schema_index,
-                                                                                     previous_export_id, filter)
+                                                                                     previous_export_id, filter,
+                                                                                     single_pass=single_pass)
             if config:
-                writer = get_writer(format)
+                writer = get_writer_for_formats(formats)
+
+                plan = FlatteningPlan(updated_schema, separator=separator)
 
                 # get cleaned up headers
-                formatted_headers = self.remap_tables(get_headers(updated_schema, separator=separator))
-                writer.open(formatted_headers, tmp, max_column_size=max_column_size)
+                formatted_headers = self.remap_tables(plan.get_headers())
+                writer.open(formatted_headers, tmp.file, max_column_size=max_column_size)
 
                 total_docs = len(config.potentially_relevant_ids)
                 if process:
@@ -555,20 +872,12 @@ class FakeSavedExportSchema(BaseSavedExportSchema):
                     if self.transform:
                         doc = self.transform(doc)
 
-                    writer.write(self.remap_tables(format_tables(create_intermediate_tables(doc, updated_schema),
-                                                                 include_headers=False, separator=separator)))
+                    writer.write(self.remap_tables(plan.flatten(doc, include_headers=False)))
                     if process:
                         DownloadBase.set_progress(process, i + 1, total_docs)
                 writer.close()
 
-            checkpoint = export_schema_checkpoint
-
-        if checkpoint:
-            if use_cache:
-                cache.set(cache_key, (path, checkpoint), CACHE_TIME)
-            return ExportFiles(path, checkpoint)
-
-        return None
+        return tmp.paths, export_schema_checkpoint
 
 
 class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
@@ -651,6 +960,16 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
             "selected": index in self.tables_by_index
         }
 
+    def get_flattening_selection(self):
+        """
+        {table index: set of column indexes} for the columns this export
+        uses, so docs are only flattened as far as they need to be
+        """
+        return dict(
+            (table.index, set(column.index for column in table.columns))
+            for table in self.tables
+        )
+
     def get_table_headers(self, override_name=False):
         return ((self.table_name if override_name and i == 0 else t.index, [t.get_headers_row()]) for i, t in enumerate(self.tables))
 
@@ -676,22 +995,81 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
         """
         self.schema_id = schema.get_id
 
-    def trim(self, document_table, doc, apply_transforms=True):
+    def get_projection_plans(self, headers, apply_transforms=True, tables=None):
+        """
+        {table index: TableProjectionPlan} for the export's tables (or `tables`)
+        that are in `headers`, as FlatteningPlan.get_headers() returns them.
+
+        Compiled once per export, with global_transform_function looked up
+        once, and passed to trim() for every doc.
+        """
+        tables_by_index = self.tables_by_index if tables is None else \
+            dict((table.index, table) for table in tables)
+        global_transform = self.global_transform_function
+        return dict(
+            (table_index, tables_by_index[table_index].get_projection_plan(
+                header_rows[0].get_data(), apply_transforms, global_transform
+            ))
+            for table_index, header_rows in headers if table_index in tables_by_index
+        )
+
+    def trim(self, document_table, doc, apply_transforms=True, projection_plans=None):
+        global_transform = self.global_transform_function
         for table_index, data in document_table:
             if self.tables_by_index.has_key(table_index):
                 # todo: currently (index, rows) instead of (display, rows); where best to convert to display?
                 yield (table_index, self.tables_by_index[table_index].trim(
-                    data, doc, apply_transforms, self.global_transform_function
+                    data, doc, apply_transforms, global_transform,
+                    projection_plans.get(table_index) if projection_plans else None
                 ))
 
-    def get_export_components(self, previous_export_id=None, filter=None):
+    def get_preview(self, limit=10, filter=None, apply_transforms=True):
+        """
+        The export's first `limit` docs as [(table index, [headers, row, ...])],
+        e.g. for previewing the columns being picked.
+
+        Only those docs are fetched, and they're flattened against the last
+        checkpoint's schema (extended with them in memory), so unlike
+        get_export_files(limit=...) nothing else is read and no
+        checkpoint is created.
+        """
+        from couchexport.export import ExportConfiguration, FlatteningPlan
+
+        with ExportConfiguration(get_db(), self.index, filter=self.filter & filter) as config:
+            docs = config.get_preview_docs(limit)
+            schema = config.get_preview_schema(docs)
+        plan = FlatteningPlan(schema, separator=".", selection=self.get_flattening_selection())
+
+        # copies, so the previewed headers aren't remembered for exports
+        tables = [ExportTable.wrap(table.to_json()) for table in self.tables]
+        tables_by_index = dict((table.index, table) for table in tables)
+        preview = [(table.index, [list(table.get_headers_row().get_data())]) for table in tables]
+        rows_by_index = dict(preview)
+        projection_plans = self.get_projection_plans(plan.get_headers(), apply_transforms,
+                                                      tables=tables)
+        global_transform = self.global_transform_function
+        for doc in docs:
+            if self.transform and apply_transforms:
+                doc = self.transform(doc)
+            for table_index, data in plan.flatten(doc):
+                if table_index in tables_by_index:
+                    rows_by_index[table_index].extend(
+                        list(row.get_data()) for row in tables_by_index[table_index].trim(
+                            data, doc, apply_transforms, global_transform,
+                            projection_plans.get(table_index)
+                        )
+                    )
+        return preview
+
+    def get_export_components(self, previous_export_id=None, filter=None, single_pass=False):
         from couchexport.export import ExportConfiguration
 
         database = get_db()
 
         config = ExportConfiguration(database, self.index,
             previous_export_id,
-            self.filter & filter)
+            self.filter & filter,
+            single_pass=single_pass)
 
         # get and checkpoint the latest schema
         updated_schema = config.get_latest_schema()
@@ -699,23 +1077,36 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
         return config, updated_schema, export_schema_checkpoint
 
     def get_export_files(self, format=None, previous_export=None, filter=None, process=None, max_column_size=None,
-                         apply_transforms=True, limit=0, **kwargs):
-        from couchexport.export import get_writer, format_tables, create_intermediate_tables
+                         apply_transforms=True, limit=0, single_pass=False, **kwargs):
         if not format:
             format = self.default_format or Format.XLS_2007
 
-        config, updated_schema, export_schema_checkpoint = self.get_export_components(previous_export, filter)
+        return self.get_multi_format_export_files(
+            [format], previous_export, filter, process=process, max_column_size=max_column_size,
+            apply_transforms=apply_transforms, limit=limit, single_pass=single_pass
+        )[format]
+
+    def get_multi_format_export_files(self, formats, previous_export=None, filter=None, process=None,
+                                      max_column_size=None, apply_transforms=True, limit=0,
+                                      single_pass=False):
+        """
+        Like get_export_files, but writes the export in each of the formats
+        from one pass over the docs and returns {format: ExportFiles}
+        """
+        from couchexport.export import get_writer_for_formats, FlatteningPlan
+
+        config, updated_schema, export_schema_checkpoint = self.get_export_components(
+            previous_export, filter, single_pass=single_pass)
 
         # transform docs onto output and save
-        writer = get_writer(format)
+        writer = get_writer_for_formats(formats)
 
         # open the doc and the headers
         formatted_headers = list(self.get_table_headers())
-        fd, path = tempfile.mkstemp()
-        with os.fdopen(fd, 'wb') as tmp:
+        with _TempFiles(len(formats)) as tmp:
             writer.open(
                 formatted_headers,
-                tmp,
+                tmp.file,
                 max_column_size=max_column_size,
                 table_titles=dict([
                     (table.index, table.display)
@@ -723,6 +1114,10 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
                 ])
             )
 
+            plan = FlatteningPlan(updated_schema, separator=".",
+                                  selection=self.get_flattening_selection())
+            # compiled for this export, so their transform caches start empty
+            projection_plans = self.get_projection_plans(plan.get_headers(), apply_transforms)
             total_docs = len(config.potentially_relevant_ids)
             if process:
                 DownloadBase.set_progress(process, 0, total_docs)
@@ -732,12 +1127,10 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
                 if self.transform and apply_transforms:
                     doc = self.transform(doc)
                 formatted_tables = self.trim(
-                    format_tables(
-                        create_intermediate_tables(doc, updated_schema),
-                        separator="."
-                    ),
+                    plan.flatten(doc),
                     doc,
-                    apply_transforms=apply_transforms
+                    apply_transforms=apply_transforms,
+                    projection_plans=projection_plans
                 )
                 writer.write(formatted_tables)
                 if process:
@@ -745,7 +1138,8 @@ class SavedExportSchema(BaseSavedExportSchema, UnicodeMixIn):
 
             writer.close()
 
-        return ExportFiles(path, export_schema_checkpoint, format)
+        return dict((format, ExportFiles(path, export_schema_checkpoint, format))
+                    for format, path in zip(formats, tmp.paths))
 
     def download_data(self, format="", previous_export=None, filter=None, limit=0):
         """
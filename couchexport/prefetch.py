@@ -0,0 +1,123 @@
+import logging
+from Queue import Queue, Full
+import threading
+import time
+from dimagi.utils.chunked import chunked
+from dimagi.utils.couch.bulk import get_docs
+
+logger = logging.getLogger(__name__)
+
+
+class DocPrefetcher(object):
+    """
+    Iterates over the docs for a list of ids like iter_docs, but fetches
+    the next chunks of ids in background threads while the caller is busy
+    with the docs it was already given.
+
+    `depth` bounds the number of chunks that are fetched (or being fetched)
+    ahead of the caller and `workers` the number of concurrent fetches.
+    `fetch` is called as fetch(database, keys=ids) to get each chunk's docs.
+
+    After iterating `stall_times` reports, in seconds, how long each stage
+    of the pipeline spent blocked on the other:
+        fetch: waiting for the caller to make room in the queue
+        process: waiting for docs to be fetched
+
+    When iteration ends, early or not, the threads are stopped and waited
+    on for up to `stop_timeout` seconds, so that whatever `fetch` reads
+    from can be closed once the iteration is over.
+    """
+    _stopped_poll_interval = 0.1
+    stop_timeout = 30
+
+    def __init__(self, database, ids, chunk_size=100, workers=2, depth=4, fetch=None):
+        self.database = database
+        self.ids = ids
+        self.fetch = fetch or get_docs
+        self.chunk_size = chunk_size
+        self.workers = max(workers, 1)
+        self.depth = max(depth, 1)
+        self.stall_times = {'fetch': 0.0, 'process': 0.0}
+        self._stopped = threading.Event()
+
+    def _put(self, queue, item):
+        # blocks until there is room, unless the consumer went away
+        start = time.time()
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=self._stopped_poll_interval)
+            except Full:
+                continue
+            else:
+                break
+        self.stall_times['fetch'] += time.time() - start
+
+    def _dispatch(self, pending, tasks):
+        try:
+            for ids in chunked(self.ids, self.chunk_size):
+                if self._stopped.is_set():
+                    break
+                slot = Queue(maxsize=1)
+                self._put(pending, slot)
+                tasks.put((slot, ids))
+        except Exception as e:
+            slot = Queue(maxsize=1)
+            slot.put((None, e))
+            self._put(pending, slot)
+        finally:
+            for _ in range(self.workers):
+                tasks.put(None)
+            self._put(pending, None)
+
+    def _fetch(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, ids = task
+            if self._stopped.is_set():
+                continue
+            try:
+                slot.put((list(self.fetch(self.database, keys=ids)), None))
+            except Exception as e:
+                slot.put((None, e))
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _join(self, threads):
+        deadline = time.time() + self.stop_timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        alive = sum(1 for thread in threads if thread.is_alive())
+        if alive:
+            logger.warning("%d doc prefetch threads still running after %ss",
+                           alive, self.stop_timeout)
+
+    def __iter__(self):
+        pending = Queue(maxsize=self.depth)
+        tasks = Queue()
+        threads = [self._start(self._dispatch, pending, tasks)]
+        for _ in range(self.workers):
+            threads.append(self._start(self._fetch, tasks))
+
+        try:
+            while True:
+                start = time.time()
+                slot = pending.get()
+                if slot is None:
+                    break
+                docs, error = slot.get()
+                self.stall_times['process'] += time.time() - start
+                if error is not None:
+                    raise error
+                for doc in docs:
+                    yield doc
+        finally:
+            self._stopped.set()
+            self._join(threads)
+            logger.debug("doc prefetch stall times: fetch %.3fs, process %.3fs",
+                         self.stall_times['fetch'], self.stall_times['process'])
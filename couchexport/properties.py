@@ -1,6 +1,7 @@
 from dateutil.parser import parse
 from dimagi.ext.couchdbkit import DateTimeProperty, Property
 import json
+from couchexport.util import parse_iso_datetime
 
 def parse_date_string(datestring, precise=False):
     """
@@ -15,6 +16,11 @@ def parse_date_string(datestring, precise=False):
     >>> parse_date_string('2013-01-03T11:27:06+03:00', True)
     datetime.datetime(2013, 1, 3, 11, 27, 6)
     """
+    parsed = parse_iso_datetime(datestring) if isinstance(datestring, basestring) else None
+    if parsed:
+        date = parsed[0]
+        return date if precise else date.replace(microsecond=0)
+
     date_with_tz = parse(datestring)
     if not precise:
         date_with_tz = date_with_tz.replace(microsecond=0)
@@ -1,10 +1,14 @@
+import copy
+from multiprocessing import Pool, current_process
 from couchdbkit.client import Database
 from django.conf import settings
 from couchexport.exceptions import SchemaInferenceError
 from couchexport.models import ExportSchema
+from dimagi.utils.chunked import chunked
+from dimagi.utils.couch.database import iter_docs
 
 
-def build_latest_schema(schema_index):
+def build_latest_schema(schema_index, workers=1):
     """
     Build a schema, directly from the index. Also creates a saved checkpoint.
     """
@@ -12,7 +16,8 @@ def build_latest_schema(schema_index):
     db = Database(settings.COUCH_DATABASE)
     previous_export = ExportSchema.last(schema_index)
     config = ExportConfiguration(db, schema_index,
-                                 previous_export=previous_export)
+                                 previous_export=previous_export,
+                                 workers=workers)
     schema = config.get_latest_schema()
     if not schema:
         return None
@@ -72,12 +77,12 @@ def extend_schema(schema, doc):
         if not schema_kind == 'string':
             raise SchemaInferenceError("%r is type %r but should be type 'string'!!" % (schema, schema_kind))
         schema_kind = 'dict'
-        schema = {'': schema_kind}
+        schema = {'': schema}
     if doc_kind != 'dict' and schema_kind == 'dict':
         if not doc_kind == 'string':
             raise SchemaInferenceError("%r is type %r but should be type 'string'!!" % (doc, doc_kind))
         doc_kind = 'dict'
-        doc = {'': doc_kind}
+        doc = {'': doc}
 
     # 4. Now that schema and doc are of the same kind
     if schema_kind == doc_kind == "dict":
@@ -93,3 +98,101 @@ def extend_schema(schema, doc):
 
     # 5. We should have covered every case above, but if not, fail hard
     raise SchemaInferenceError("Mismatched schema (%r) and doc (%r)" % (schema, doc))
+
+
+def merge_schemas(schema1, schema2):
+    """
+    Merge two schemas by the same rules extend_schema uses to merge a doc
+    into a schema. Unlike extend_schema, the result doesn't depend on the
+    order in which schemas are merged, so partial schemas built from
+    separate sets of docs can be combined in any order.
+
+    schema1 may be modified in place; schema2 is left untouched.
+    """
+    schema1_kind = get_kind(schema1)
+    schema2_kind = get_kind(schema2)
+
+    # 1. anything + null => anything
+    if schema2_kind == "null":
+        return schema1
+    if schema1_kind == "null":
+        return copy.deepcopy(schema2)
+
+    # 2. not-list => [not-list] when compared to a list
+    if schema1_kind != "list" and schema2_kind == "list":
+        schema1_kind = "list"
+        schema1 = [schema1]
+    if schema2_kind != "list" and schema1_kind == "list":
+        schema2_kind = "list"
+        schema2 = [schema2]
+
+    # 3. not-dict => {'': not-dict} when compared to a dict
+    if schema1_kind != "dict" and schema2_kind == "dict":
+        schema1_kind = "dict"
+        schema1 = {'': schema1}
+    if schema2_kind != "dict" and schema1_kind == "dict":
+        schema2_kind = "dict"
+        schema2 = {'': schema2}
+
+    # 4. Now that both schemas are of the same kind
+    if schema1_kind == schema2_kind == "dict":
+        for key in schema2:
+            schema1[key] = merge_schemas(schema1.get(key, None), schema2[key])
+        return schema1
+    if schema1_kind == schema2_kind == "list":
+        schema1[0] = merge_schemas(schema1[0], schema2[0])
+        return schema1
+    if schema1_kind == schema2_kind == "string":
+        return "string"
+
+    # 5. We should have covered every case above, but if not, fail hard
+    raise SchemaInferenceError("Mismatched schemas (%r) and (%r)" % (schema1, schema2))
+
+
+def _infer_schema(database, doc_ids, schema=None, cleanup_fn=None, doc_cache=None):
+    docs = doc_cache.iter_docs(database, doc_ids) if doc_cache else iter_docs(database, doc_ids)
+    for doc in docs:
+        if cleanup_fn:
+            doc = cleanup_fn(doc)
+        schema = extend_schema(schema, doc)
+    return schema
+
+
+def _infer_schema_chunk(args):
+    # runs in a worker process, so it gets its own connection to the database
+    database_uri, doc_ids, cleanup_fn = args
+    return _infer_schema(Database(database_uri), doc_ids, cleanup_fn=cleanup_fn)
+
+
+def infer_schema(database, doc_ids, schema=None, cleanup_fn=None, workers=1,
+                 chunk_size=10000, doc_cache=None):
+    """
+    Extend `schema` with every doc in `doc_ids`, fetched through
+    `doc_cache` (a DocCache) if there is one.
+
+    With more than one worker the ids are split into chunks of `chunk_size`,
+    a partial schema is built for each chunk in a process pool and the
+    partial schemas are combined with merge_schemas.
+    cleanup_fn must be picklable (i.e. a module level function) in that case.
+
+    Daemonic processes (e.g. celery prefork workers) can't start a pool,
+    so there the docs are always read with a single worker.
+    The worker processes don't use the doc_cache.
+    """
+    if workers <= 1 or current_process().daemon:
+        return _infer_schema(database, doc_ids, schema, cleanup_fn, doc_cache)
+
+    pool = Pool(workers)
+    try:
+        partial_schemas = pool.imap_unordered(_infer_schema_chunk, (
+            (database.uri, ids, cleanup_fn) for ids in chunked(doc_ids, chunk_size)
+        ))
+        for partial_schema in partial_schemas:
+            schema = merge_schemas(schema, partial_schema)
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return schema
@@ -39,14 +39,15 @@ def export_async(custom_export, download_id, format=None, filename=None, **kwarg
 
 
 @task
-def rebuild_schemas(index):
+def rebuild_schemas(index, workers=1):
     """
     Resets the schema for all checkpoints to the latest version based off the
     current document structure. Returns the number of checkpoints updated.
     """
     db = ExportSchema.get_db()
     all_checkpoints = ExportSchema.get_all_checkpoints(index)
-    config = ExportConfiguration(db, index, disable_checkpoints=True)
+    config = ExportConfiguration(db, index, disable_checkpoints=True,
+                                 workers=workers)
     latest = config.create_new_checkpoint()
     for cp in all_checkpoints:
         cp.schema = latest.schema
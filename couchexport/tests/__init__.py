@@ -1,8 +1,13 @@
 from .test_cleanup import *
+from .test_doccache import *
+from .test_export import *
+from .test_flatten import *
+from .test_prefetch import *
 from .test_raw import *
 from .test_saved import *
 from .test_schema import *
 from .test_transforms import *
+from .test_util import *
 from .test_writers import *
 from couchexport.properties import parse_date_string
 
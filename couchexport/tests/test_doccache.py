@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import tempfile
+from django.test import SimpleTestCase
+from mock import patch
+from couchexport.doccache import DocCache
+from couchexport.export import ExportConfiguration
+
+
+class FakeDatabase(object):
+
+    def __init__(self, docs):
+        self.docs = dict((doc['_id'], doc) for doc in docs)
+        self.fetched = []
+
+    def view(self, view_name, keys):
+        assert view_name == '_all_docs'
+        for key in keys:
+            if key in self.docs:
+                yield {'id': key, 'key': key, 'value': {'rev': self.docs[key]['_rev']}}
+            else:
+                yield {'key': key, 'error': 'not_found'}
+
+    def get_docs(self, database, keys):
+        self.fetched.extend(keys)
+        return [dict(self.docs[key]) for key in keys]
+
+
+class DocCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.db = FakeDatabase([
+            {'_id': 'doc%d' % i, '_rev': '1-a', 'value': i} for i in range(10)
+        ])
+        self.get_docs_patch = patch('couchexport.doccache.get_docs', self.db.get_docs)
+        self.get_docs_patch.start()
+
+    def tearDown(self):
+        self.get_docs_patch.stop()
+        os.remove(self.path)
+
+    def test_hits_and_misses(self):
+        ids = ['doc%d' % i for i in range(10)] + ['missing']
+        cache = DocCache(self.path)
+        self.assertEqual(10, len(list(cache.iter_docs(self.db, ids, chunksize=4))))
+        self.assertEqual((0, 10), (cache.hits, cache.misses))
+
+        self.db.docs['doc3'] = {'_id': 'doc3', '_rev': '2-b', 'value': 'changed'}
+        self.db.fetched = []
+        cache = DocCache(self.path)
+        docs = list(cache.iter_docs(self.db, ids))
+        self.assertEqual(['doc%d' % i for i in range(10)], [doc['_id'] for doc in docs])
+        self.assertEqual('changed', docs[3]['value'])
+        self.assertEqual(['doc3'], self.db.fetched)
+        self.assertEqual((9, 1), (cache.hits, cache.misses))
+
+    def test_eviction(self):
+        cache = DocCache(self.path, max_size=200)
+        list(cache.iter_docs(self.db, ['doc%d' % i for i in range(10)], chunksize=1))
+        self.assertLessEqual(cache._size, 200)
+        self.db.fetched = []
+        list(cache.iter_docs(self.db, ['doc0', 'doc9']))
+        # the oldest docs were evicted, the newest were kept
+        self.assertEqual(['doc0'], self.db.fetched)
+
+    def test_export_configuration_closes_its_cache(self):
+        with self.settings(COUCHEXPORT_DOC_CACHE_PATH=self.path):
+            config = ExportConfiguration(self.db, ['tag'], disable_checkpoints=True)
+            config.potentially_relevant_ids = ['doc%d' % i for i in range(10)]
+            # only opened while docs are read through it
+            self.assertIsNone(config._doc_cache)
+            docs = config.enum_docs()
+            next(docs)
+            cache = config._doc_cache
+            self.assertEqual(9, len(list(docs)))
+            self.assertIsNone(config._doc_cache)
+            with self.assertRaises(sqlite3.ProgrammingError):
+                cache._db.execute("SELECT 1")
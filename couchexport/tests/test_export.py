@@ -0,0 +1,140 @@
+from django.test import SimpleTestCase
+from mock import patch
+from couchexport.export import ExportConfiguration
+from couchexport.files import SpillFile
+from couchexport.models import ExportSchema, SavedExportSchema, ExportTable, ExportColumn
+from couchexport.tests.test_util import FakeSchemaIndexDatabase
+from couchexport.util import SerializableFunction
+
+
+class SpillFileTest(SimpleTestCase):
+
+    def test_round_trip(self):
+        spill = SpillFile()
+        items = [(i, {'_id': 'doc%d' % i, 'values': [i, u'\xe9', None]}) for i in range(50)]
+        for item in items:
+            spill.write(item)
+        self.assertEqual(50, len(spill))
+        self.assertEqual(items, list(spill))
+        # can be read more than once
+        self.assertEqual(items, list(spill))
+        spill.close()
+
+
+class SinglePassExportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = [
+            {'_id': 'a', 'name': 'bob', 'keep': True, '_attachments': {'form.xml': {}}},
+            {'_id': 'b', 'name': {'first': 'carl'}, 'keep': False},
+            {'_id': 'c', 'name': 'dan', 'tags': ['x', 'y'], 'keep': True},
+        ]
+        self.fetches = 0
+
+    def _iter_docs(self, database, ids):
+        self.fetches += 1
+        for doc in self.docs:
+            yield dict(doc)
+
+    def _config(self, **kwargs):
+        return ExportConfiguration(None, ['tag'], disable_checkpoints=True,
+                                   filter=lambda doc: doc['keep'], **kwargs)
+
+    def test_single_pass(self):
+        with patch('couchexport.export.iter_docs', self._iter_docs), \
+                patch('couchexport.schema.iter_docs', self._iter_docs):
+            expected_schema = self._config().get_latest_schema()
+            expected_docs = list(self._config().enum_docs())
+            self.fetches = 0
+
+            config = self._config(single_pass=True)
+            self.assertEqual(expected_schema, config.get_latest_schema())
+            spilled_docs = config._spilled_docs
+            self.assertEqual(expected_docs, list(config.enum_docs()))
+            self.assertEqual(1, self.fetches)
+            self.assertTrue(spilled_docs._file.closed)
+
+
+
+class PreviewTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = dict(
+            ('doc%d' % i, {'_id': 'doc%d' % i, 'name': 'name%d' % i, 'keep': i % 2 == 0,
+                           'kids': [{'age': i + 1}], '_attachments': {}})
+            for i in range(10)
+        )
+        self.db = FakeSchemaIndexDatabase(
+            [{'key': ['tag', '2015-01-%02d' % (i + 1)], 'id': 'doc%d' % i} for i in range(10)],
+            self.docs,
+        )
+        # from before docs had kids
+        self.checkpoint = ExportSchema(index=['tag'], schema={'_id': 'string', 'name': 'string',
+                                                              'keep': 'string'})
+        self.export = SavedExportSchema(index=['tag'], tables=[
+            ExportTable(index='#', columns=[ExportColumn(index='name', display='Name'),
+                                            ExportColumn(index='id', display='Id')]),
+            ExportTable(index='#.kids.#', columns=[ExportColumn(index='age', display='Age')]),
+        ], filter_function=SerializableFunction(_keep))
+
+    def test_preview(self):
+        with patch('couchexport.models.get_db', return_value=self.db), \
+                patch('couchexport.export.ExportSchema.last', return_value=self.checkpoint):
+            preview = self.export.get_preview(limit=3)
+        self.assertEqual([
+            ('#', [['Name', 'Id'], ['name0', '0'], ['name2', '0'], ['name4', '0']]),
+            ('#.kids.#', [['Age'], ['1'], ['3'], ['5']]),
+        ], [(index, [list(map(unicode, row)) for row in rows]) for index, rows in preview])
+        # one (larger, as there's a filter) page of docs, and nothing counted
+        self.assertEqual([False], self.db.queries)
+
+    def test_preview_scans_a_limited_number_of_docs(self):
+        with self.settings(COUCHEXPORT_PREVIEW_MAX_DOCS_SCANNED=4,
+                           COUCHEXPORT_PREVIEW_FILTERED_PAGE_SIZE=3), \
+                patch('couchexport.models.get_db', return_value=self.db), \
+                patch('couchexport.export.ExportSchema.last', return_value=self.checkpoint):
+            preview = self.export.get_preview(limit=3)
+        self.assertEqual([['Name', 'Id'], ['name0', '0'], ['name2', '0']],
+                         [list(map(unicode, row)) for row in preview[0][1]])
+        self.assertEqual([False, False], self.db.queries)
+
+    def test_projection_plans_compiled_once(self):
+        from couchexport.models import TableProjectionPlan
+
+        class MarkedExportSchema(SavedExportSchema):
+            @property
+            def global_transform_function(self):
+                # a new callable every time
+                return lambda value, doc: u'*%s' % value
+
+        export = MarkedExportSchema.wrap(self.export.to_json())
+        with patch('couchexport.models.get_db', return_value=self.db), \
+                patch('couchexport.export.ExportSchema.last', return_value=self.checkpoint), \
+                patch('couchexport.models.TableProjectionPlan', wraps=TableProjectionPlan) as plans:
+            preview = export.get_preview(limit=3)
+        self.assertEqual(2, plans.call_count)
+        self.assertEqual([['Name', 'Id'], ['*name0', '0'], ['*name2', '0'], ['*name4', '0']],
+                         [list(map(unicode, row)) for row in preview[0][1]])
+
+
+def _keep(doc):
+    return doc['keep']
+
+
+class GroupExportsBySchemaTest(SimpleTestCase):
+
+    def test_formats_of_the_same_export_are_grouped(self):
+        from couchexport.groupexports import group_exports_by_schema
+        from couchexport.models import ExportConfiguration as GroupedExportConfiguration, \
+            FakeSavedExportSchema
+        exports = [
+            (GroupedExportConfiguration(index=['d', 'x'], name='x', format=format),
+             FakeSavedExportSchema(index=['d', 'x'], type='form'))
+            for format in ('xlsx', 'csv')
+        ] + [
+            (GroupedExportConfiguration(index=['d', 'y'], name='y', format='csv'),
+             FakeSavedExportSchema(index=['d', 'y'], type='form'))
+        ]
+        groups = group_exports_by_schema(exports)
+        self.assertEqual([['xlsx', 'csv'], ['csv']],
+                         [[config.format for config in configs] for configs, _ in groups])
@@ -0,0 +1,114 @@
+from django.test import SimpleTestCase
+from couchexport.exceptions import SchemaMismatchException
+from couchexport.export import FlatteningPlan, format_tables, create_intermediate_tables, \
+    scalar_never_was
+from couchexport.models import ExportTable, ExportColumn
+from couchexport.schema import make_schema
+
+
+def _dump(tables):
+    return [
+        (name, [(list(row.get_data()), row.id) for row in rows])
+        for name, rows in tables
+    ]
+
+
+class FlatteningPlanTest(SimpleTestCase):
+
+    def setUp(self):
+        self.doc = {
+            'name': 'bob',
+            'age': 3,
+            'address': {'city': 'Boston', 'zip': ''},
+            'children': [
+                {'name': 'alice', 'pets': ['cat', 'dog']},
+                {'name': 'carl', 'pets': 'fish'},
+            ],
+            'empty': None,
+        }
+        self.schema = make_schema(self.doc)
+
+    def assertMatchesIntermediateTables(self, doc, schema, **kwargs):
+        plan = FlatteningPlan(schema, separator=kwargs.get('separator', '.'))
+        self.assertEqual(
+            _dump(format_tables(create_intermediate_tables(doc, schema), **kwargs)),
+            _dump(plan.flatten(doc, include_headers=kwargs.get('include_headers', True))),
+        )
+
+    def test_flatten(self):
+        self.assertMatchesIntermediateTables(self.doc, self.schema)
+        self.assertMatchesIntermediateTables(self.doc, self.schema, separator='|',
+                                             include_headers=False)
+
+    def test_flatten_never_was(self):
+        doc = {'name': 'dan', 'children': [{'name': 'erin'}]}
+        self.assertMatchesIntermediateTables(doc, self.schema)
+        [(_, root_rows), (_, children_rows)] = FlatteningPlan(self.schema).flatten(doc)
+        self.assertEqual(
+            list(children_rows[1].get_data()),
+            ['0.0', 0, 0, 'erin'],
+        )
+        self.assertEqual(list(root_rows[1].get_data())[1:3], [scalar_never_was] * 2)
+
+    def test_headers(self):
+        plan = FlatteningPlan(self.schema, separator='|')
+        self.assertEqual(
+            _dump(format_tables(create_intermediate_tables(self.schema, self.schema),
+                                include_data=False, separator='|')),
+            _dump(plan.get_headers()),
+        )
+        self.assertEqual([], FlatteningPlan(None).get_headers())
+
+    def test_mismatch(self):
+        with self.assertRaises(SchemaMismatchException):
+            FlatteningPlan(self.schema).flatten({'not_in_schema': 'value'})
+        with self.assertRaises(SchemaMismatchException):
+            FlatteningPlan(self.schema).flatten({'empty': 'not empty'})
+
+    def test_selection(self):
+        selection = {'#': {'name', 'address.zip'}, '#.children.#.pets.#': set()}
+        plan = FlatteningPlan(self.schema, selection=selection)
+        self.assertEqual(
+            [('#', [(['id', 'address.zip', 'name'], ['id'])]),
+             ('#.children.#.pets.#', [(['id', 'id__0', 'id__1', 'id__2'],
+                                       ['id', 'id__0', 'id__1', 'id__2'])])],
+            _dump(plan.get_headers()),
+        )
+        self.assertEqual(
+            [('#', [(['id', 'address.zip', 'name'], ['id']), (['0', None, 'bob'], (0,))]),
+             ('#.children.#.pets.#', [
+                 (['id', 'id__0', 'id__1', 'id__2'], ['id', 'id__0', 'id__1', 'id__2']),
+                 (['0.0.0', 0, 0, 0], (0, 0, 0)),
+                 (['0.0.1', 0, 0, 1], (0, 0, 1)),
+                 (['0.1.0', 0, 1, 0], (0, 1, 0)),
+             ])],
+            _dump(plan.flatten(self.doc)),
+        )
+
+    def test_selection_trims_the_same(self):
+        def _tables():
+            return [
+                ExportTable(index='#', columns=[
+                    ExportColumn(index='address.city', display='city'),
+                    ExportColumn(index='id', display='id'),
+                ]),
+                ExportTable(index='#.children.#', columns=[
+                    ExportColumn(index='name', display='name'),
+                    ExportColumn(index='missing', display='missing'),
+                ]),
+            ]
+
+        def _trim(tables, flattened):
+            flattened = dict(flattened)
+            return [[list(row.get_data()) for row in table.trim(flattened[table.index], doc, True, None)]
+                    for table in tables]
+
+        tables = _tables()
+        plan = FlatteningPlan(self.schema, selection=dict(
+            (table.index, set(column.index for column in table.columns)) for table in tables
+        ))
+        full_tables = _tables()
+        full_plan = FlatteningPlan(self.schema)
+        for doc in [self.doc, {'name': 'dan', 'children': [{'name': 'erin'}]}]:
+            self.assertEqual(_trim(full_tables, full_plan.flatten(doc)),
+                             _trim(tables, plan.flatten(doc)))
@@ -0,0 +1,47 @@
+import time
+from django.test import SimpleTestCase
+from mock import patch
+from couchexport.prefetch import DocPrefetcher
+
+
+def _get_docs(database, keys):
+    if 'bad' in keys:
+        raise ValueError('bad id')
+    return [{'_id': key} for key in keys]
+
+
+@patch('couchexport.prefetch.get_docs', _get_docs)
+class DocPrefetcherTest(SimpleTestCase):
+
+    def test_docs_in_order(self):
+        ids = ['doc%d' % i for i in range(95)]
+        prefetcher = DocPrefetcher(None, ids, chunk_size=10, workers=3, depth=2)
+        self.assertEqual(ids, [doc['_id'] for doc in prefetcher])
+        self.assertEqual(set(['fetch', 'process']), set(prefetcher.stall_times))
+
+    def test_stop_early(self):
+        ids = ['doc%d' % i for i in range(1000)]
+        docs = iter(DocPrefetcher(None, ids, chunk_size=10, workers=2, depth=1))
+        self.assertEqual('doc0', next(docs)['_id'])
+        docs.close()
+
+    def test_stop_waits_for_fetches(self):
+        fetching = []
+
+        def slow_get_docs(database, keys):
+            fetching.append(keys)
+            time.sleep(0.05)
+            fetching.remove(keys)
+            return _get_docs(database, keys)
+
+        ids = ['doc%d' % i for i in range(1000)]
+        docs = iter(DocPrefetcher(None, ids, chunk_size=10, workers=4, depth=4,
+                                  fetch=slow_get_docs))
+        self.assertEqual('doc0', next(docs)['_id'])
+        docs.close()
+        self.assertEqual([], fetching)
+
+    def test_error(self):
+        ids = ['doc1', 'doc2', 'bad', 'doc3']
+        with self.assertRaises(ValueError):
+            list(DocPrefetcher(None, ids, chunk_size=1, workers=2))
@@ -1,8 +1,12 @@
 # coding=utf-8
 import datetime
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from couchexport.export import Constant, FormattedRow
 from couchexport.groupexports import get_saved_export_and_delete_copies
-from couchexport.models import SavedBasicExport, ExportConfiguration
+from couchexport.models import SavedBasicExport, ExportConfiguration, ExportTable, ExportColumn, \
+    SplitColumn, ColumnTransform
+from couchexport.transforms import value_pure, batch_transform
+from couchexport.util import SerializableFunction
 
 
 class SavedExportTest(TestCase):
@@ -52,3 +56,160 @@ class SavedExportTest(TestCase):
 
 def _mk_config(name='some export name', index='dummy_index'):
     return ExportConfiguration(index=index, name=name, format='xlsx')
+
+
+def _upper(val, doc):
+    return val.upper()
+
+
+def _fail(val, doc):
+    raise ValueError(val)
+
+
+def _mark(val, doc):
+    return u'*%s' % val
+
+
+_calls = []
+
+
+@value_pure
+def _counted_upper(val, doc):
+    _calls.append(val)
+    return val.upper()
+
+
+def _upper_many(vals, doc, suffix=''):
+    _calls.append(list(vals))
+    if 'fail' in vals:
+        raise ValueError(vals)
+    return [_upper_each(val, doc, suffix) for val in vals]
+
+
+@value_pure
+@batch_transform(_upper_many)
+def _upper_each(val, doc, suffix=''):
+    if val == 'fail':
+        raise ValueError(val)
+    return val.upper() + suffix if isinstance(val, basestring) else val
+
+
+class ExportTableTrimTest(SimpleTestCase):
+
+    def setUp(self):
+        self.data = [
+            FormattedRow(['form.name', 'form.color', 'form.n'], ['id'], is_header_row=True),
+            FormattedRow(['alice', 'red blue green', '1'], ('0',)),
+            FormattedRow(['bob', Constant('---'), '2'], ('1',)),
+        ]
+
+    def _trim(self, columns, apply_transforms=True, global_transform=None):
+        table = ExportTable(index='#', columns=columns)
+        return [(row.id, row.id_index, list(row.get_data()))
+                for row in table.trim(self.data, {}, apply_transforms, global_transform)]
+
+    def test_plain_columns(self):
+        columns = [ExportColumn(index='form.n', display='n'),
+                   ExportColumn(index='form.name', display='name')]
+        self.assertEqual([(None, 0, ['1', 'alice']), (None, 0, ['2', 'bob'])],
+                         self._trim(columns))
+
+    def test_id_split_missing_and_transforms(self):
+        columns = [
+            ExportColumn(index='form.name', display='name',
+                         transform=SerializableFunction(_upper)),
+            ExportColumn(index='id', display='id'),
+            SplitColumn(index='form.color', display='color', options=['red', 'green']),
+            ExportColumn(index='form.missing', display='missing'),
+            ExportColumn(index='form.n', display='n', transform=SerializableFunction(_fail)),
+        ]
+        rows = self._trim(columns, global_transform=_mark)
+        self.assertEqual(('0',), rows[0][0])
+        self.assertEqual(1, rows[0][1])
+        self.assertEqual(['ALICE', '0', '*1', '*1', '*blue', '*', '---ERR---'],
+                         map(unicode, rows[0][2]))
+        self.assertEqual(['BOB', '1', '*---', '*---', '*---', '*', '---ERR---'],
+                         map(unicode, rows[1][2]))
+
+    def test_without_transforms(self):
+        columns = [ExportColumn(index='form.name', display='name',
+                                transform=SerializableFunction(_fail))]
+        self.assertEqual([(None, 0, ['alice']), (None, 0, ['bob'])],
+                         self._trim(columns, apply_transforms=False))
+
+
+class ColumnTransformTest(SimpleTestCase):
+
+    def setUp(self):
+        del _calls[:]
+
+    def test_value_pure_transforms_are_cached(self):
+        transform = ColumnTransform(SerializableFunction(_counted_upper), None, cache_size=2)
+        self.assertEqual(['A', 'A', 'B', 'A', 'C', 'B'],
+                         [transform(val, {}) for val in 'aabacb'])
+        # b was the least recently used value when c was added
+        self.assertEqual(['a', 'b', 'c', 'b'], _calls)
+
+    def test_other_transforms_arent_cached(self):
+        transform = ColumnTransform(SerializableFunction(_mark), None, cache_size=10)
+        self.assertIsNone(transform.cache)
+
+    def test_cache_dropped_when_values_dont_repeat(self):
+        transform = ColumnTransform(SerializableFunction(_counted_upper), None, cache_size=100)
+        transform.cache_window = 10
+        for val in 'abcdefghij':
+            transform(val, {})
+        self.assertIsNone(transform.cache)
+        self.assertEqual('A', transform('a', {}))
+        self.assertEqual(11, len(_calls))
+
+    def test_cache_kept_when_values_repeat(self):
+        transform = ColumnTransform(SerializableFunction(_counted_upper), None, cache_size=100)
+        transform.cache_window = 10
+        for val in 'abababababababababab':
+            transform(val, {})
+        self.assertIsNotNone(transform.cache)
+        self.assertEqual(['a', 'b'], _calls)
+
+    def test_cache_keeps_types_apart(self):
+        transform = ColumnTransform(SerializableFunction(value_pure(lambda val, doc: repr(val))),
+                                    None, cache_size=10)
+        self.assertEqual(["'1'", '1', '1.0', "[u'1']"],
+                         [transform(val, {}) for val in ['1', 1, 1.0, [u'1']]])
+
+    def test_constants_get_the_global_transform(self):
+        transform = ColumnTransform(SerializableFunction(_counted_upper), _mark, cache_size=10)
+        self.assertEqual(u'*---', transform(Constant('---'), {}))
+        self.assertEqual([], _calls)
+
+    def test_transform_all(self):
+        transform = ColumnTransform(SerializableFunction(_upper_each, suffix='!'), _mark,
+                                    cache_size=10)
+        self.assertEqual('A!', transform('a', {}))
+        self.assertEqual(['A!', 'B!', u'*---', 'C!'],
+                         transform.transform_all(['a', 'b', Constant('---'), 'c'], {}))
+        # a was cached, the rest went in a single batch
+        self.assertEqual([['b', 'c']], _calls)
+
+    def test_transform_all_falls_back_on_errors(self):
+        transform = ColumnTransform(SerializableFunction(_upper_each), None, cache_size=10)
+        self.assertEqual(['A', '---ERR---'],
+                         map(unicode, transform.transform_all(['a', 'fail'], {})))
+
+    def test_trim_with_batch_transform(self):
+        table = ExportTable(index='#', columns=[
+            ExportColumn(index='form.name', display='name',
+                         transform=SerializableFunction(_upper_each)),
+            SplitColumn(index='form.color', display='color', options=['red', 'green'],
+                        transform=SerializableFunction(_upper_each)),
+        ])
+        data = [
+            FormattedRow(['form.name', 'form.color'], ['id'], is_header_row=True),
+            FormattedRow(['alice', 'red blue'], ('0',)),
+            FormattedRow(['bob', 'green'], ('1',)),
+        ]
+        self.assertEqual(
+            [['ALICE', 1, None, 'BLUE'], ['BOB', None, 1, None]],
+            [list(row.get_data()) for row in table.trim(data, {}, True, None)]
+        )
+        self.assertEqual([['alice', 'bob'], [1, None, 'blue', None, 1, None]], _calls)
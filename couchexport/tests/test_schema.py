@@ -1,8 +1,10 @@
 from couchdbkit.ext.django.loading import get_db
 from django.test import TestCase, SimpleTestCase
-from couchexport.export import SCALAR_NEVER_WAS
+from couchexport.export import SCALAR_NEVER_WAS, Constant
 from couchexport.models import ExportSchema, SavedExportSchema, SplitColumn
+from couchexport.schema import extend_schema, make_schema, merge_schemas
 from datetime import datetime, timedelta
+import itertools
 from couchexport.util import SerializableFunction
 from dimagi.utils.couch.database import get_safe_write_kwargs
 import json
@@ -161,6 +163,28 @@ class SavedSchemaTest(TestCase):
         )
 
 
+class SplitColumnTest(SimpleTestCase):
+
+    def test_repeated_tokens_and_options(self):
+        col = SplitColumn(display='test', options=['a', 'b', 'a', ''])
+        self.assertEqual([1, None, 1, None, 'c'], col.get_data('c a a'))
+        self.assertEqual([1, None, 1, None, 'c a'], col.get_data('a c a a'))
+        self.assertEqual([None, 1, None, 1, ' '], col.get_data(' b  '))
+
+    def test_constant(self):
+        col = SplitColumn(display='test', options=['a', 'b'])
+        constant = Constant('---')
+        self.assertEqual([constant] * 3, col.get_data(constant))
+        col.ignore_extras = True
+        self.assertEqual([constant] * 2, col.get_data(constant))
+
+    def test_options_changed(self):
+        col = SplitColumn(display='test', options=['a'])
+        self.assertEqual([1, 'b'], col.get_data('a b'))
+        col.options = ['a', 'b']
+        self.assertEqual([1, 1, None], col.get_data('a b'))
+
+
 class ExportSchemaWrapTest(SimpleTestCase):
     def test_wrap_datetime_hippy(self):
         schema1 = ExportSchema(
@@ -179,3 +203,61 @@ class ExportSchemaWrapTest(SimpleTestCase):
         )
         schema_good = ExportSchema.wrap(schema_bad.to_json())
         self.assertEqual(schema_good.timestamp, datetime(1970, 1, 1))
+
+
+class MergeSchemasTest(SimpleTestCase):
+    docs = [
+        {'name': 'bob', 'tags': ['a', 'b'], 'address': {'city': 'Boston'}},
+        {'name': None, 'tags': 'c', 'address': 'unknown', 'pets': []},
+        {'name': 'carl', 'tags': ['d'], 'address': {'zip': '02139'}, 'pets': [{'kind': 'cat'}]},
+    ]
+
+    def _schemas(self):
+        return [make_schema(doc) for doc in self.docs]
+
+    def test_matches_extend_schema(self):
+        serial = None
+        for doc in self.docs:
+            serial = extend_schema(serial, doc)
+        merged = None
+        for schema in self._schemas():
+            merged = merge_schemas(merged, schema)
+        self.assertEqual(serial, merged)
+
+    def test_commutative_and_associative(self):
+        for a, b, c in itertools.permutations(range(3)):
+            schemas = self._schemas()
+            left = merge_schemas(merge_schemas(schemas[a], schemas[b]), schemas[c])
+            schemas = self._schemas()
+            right = merge_schemas(schemas[a], merge_schemas(schemas[b], schemas[c]))
+            self.assertEqual(left, right)
+            self.assertEqual(left, merge_schemas(merge_schemas(None, schemas[2]),
+                                                 merge_schemas(schemas[1], schemas[0])))
+
+    def test_mixed_kinds_match_extend_schema(self):
+        docs = [
+            {'x': 'a', 'y': {'z': 'b'}},
+            {'x': {'y': 'b'}, 'y': 'c'},
+            {'x': ['d'], 'y': None},
+            {'x': [{'w': 'e'}], 'y': {'z': {'v': 'f'}}},
+        ]
+        for ordered in itertools.permutations(docs):
+            serial = None
+            for doc in ordered:
+                serial = extend_schema(serial, doc)
+            # like infer_schema with several workers: a partial schema per
+            # chunk of docs, merged in whatever order the chunks finish
+            chunks = [ordered[:2], ordered[2:]]
+            for chunk_order in (chunks, chunks[::-1]):
+                merged = None
+                for chunk in chunk_order:
+                    partial = None
+                    for doc in chunk:
+                        partial = extend_schema(partial, doc)
+                    merged = merge_schemas(merged, partial)
+                self.assertEqual(serial, merged)
+
+    def test_second_schema_untouched(self):
+        first, second, _ = self._schemas()
+        merge_schemas(first, second)
+        self.assertEqual(make_schema(self.docs[1]), second)
@@ -1,5 +1,8 @@
+import datetime
 from django.test import SimpleTestCase
+from couchexport.properties import parse_date_string
 from couchexport.transforms import couch_to_excel_datetime
+from couchexport.util import parse_iso_datetime
 
 
 class ExportTransformTest(SimpleTestCase):
@@ -9,3 +12,37 @@ class ExportTransformTest(SimpleTestCase):
 
     def test_couch_to_excel_datetime_old_fmt(self):
         self.assertEqual('2014-10-07 12:27:15', couch_to_excel_datetime('2014-10-07T12:27:15Z', {}))
+
+    def test_couch_to_excel_datetime_other_values(self):
+        for val in ['2015-05-14T13:03:06+03:00', '2015-05-14T13:03:06', '1850-05-14T13:03:06Z',
+                    '2015-02-30T13:03:06Z', '2015-05-14T13:03:06.1234567Z', 'nope', 5]:
+            self.assertEqual(val, couch_to_excel_datetime(val, {}))
+
+    def test_couch_to_excel_datetime_falls_back_to_strptime(self):
+        self.assertEqual('2015-05-04 01:03:06', couch_to_excel_datetime('2015-5-4T1:03:06Z', {}))
+
+
+class ParseIsoDatetimeTest(SimpleTestCase):
+
+    def test_shapes(self):
+        self.assertEqual((datetime.datetime(2013, 1, 3, 11, 27, 6, 45000), 'Z'),
+                         parse_iso_datetime('2013-01-03T11:27:06.045Z'))
+        self.assertEqual((datetime.datetime(2013, 1, 3, 11, 27, 6), ''),
+                         parse_iso_datetime(u'2013-01-03T11:27:06'))
+        self.assertEqual((datetime.datetime(2013, 1, 3, 11, 27, 6, 100000), '-05:30'),
+                         parse_iso_datetime('2013-01-03T11:27:06.1-05:30'))
+
+    def test_misses(self):
+        for value in ['2013-01-03 11:27:06', '2013-1-03T11:27:06', '2013-01-03T11:27:06.Z',
+                      '2013-13-03T11:27:06Z', '2013-01-03T11:27:06+0300', ' 013-01-03T11:27:06',
+                      u'2013-01-0\u0663T11:27:06']:
+            self.assertIsNone(parse_iso_datetime(value), value)
+
+    def test_parse_date_string(self):
+        self.assertEqual(datetime.datetime(2013, 1, 3, 11, 27, 6),
+                         parse_date_string('2013-01-03T11:27:06.045000Z'))
+        self.assertEqual(datetime.datetime(2013, 1, 3, 11, 27, 6, 45000),
+                         parse_date_string('2013-01-03T11:27:06.045000+03:00', True))
+        # falls back to dateutil
+        self.assertEqual(datetime.datetime(2013, 1, 3, 11, 27),
+                         parse_date_string('Jan 3 2013 11:27'))
@@ -0,0 +1,208 @@
+from datetime import datetime
+from django.test import SimpleTestCase
+from couchexport.export import ExportConfiguration
+from couchexport.models import ExportSchema
+from couchexport.util import SchemaIndexIds, SerializableFunction, export_date_range, \
+    get_schema_index_view_keys, CompiledFilter
+
+
+class FakeViewResults(list):
+
+    def all(self):
+        return list(self)
+
+    def one(self):
+        return self[0] if self else None
+
+
+class FakeSchemaIndexDatabase(object):
+    """
+    Just enough of the schema_index view to page through its rows
+    """
+
+    def __init__(self, rows, docs=None):
+        self.rows = sorted(rows, key=lambda row: (row['key'], row['id']))
+        self.docs = docs or {}
+        self.queries = []
+
+    def view(self, view_name, reduce=True, startkey=None, endkey=None,
+             startkey_docid=None, skip=0, limit=None, include_docs=False):
+        self.queries.append(reduce)
+        rows = [row for row in self.rows
+                if (row['key'], row['id']) >= (startkey, startkey_docid)]
+        if reduce:
+            return FakeViewResults([{'key': None, 'value': len(rows)}] if rows else [])
+        rows = rows[skip:skip + limit]
+        if include_docs:
+            rows = [dict(row, doc=self.docs[row['id']]) for row in rows]
+        return FakeViewResults(rows)
+
+
+class SchemaIndexIdsTest(SimpleTestCase):
+
+    def setUp(self):
+        # several docs share a key, so pages have to restart by doc id
+        self.rows = [
+            {'key': ['tag', '2015-01-0%d' % (i % 3)], 'id': 'doc%02d' % i, 'value': None}
+            for i in range(25)
+        ]
+
+    def test_paging(self):
+        db = FakeSchemaIndexDatabase(self.rows)
+        ids = SchemaIndexIds(db, ['tag'], ['tag', {}], page_size=4)
+        self.assertEqual([row['id'] for row in db.rows], list(ids))
+        self.assertEqual(7, db.queries.count(False))
+
+    def test_exact_pages(self):
+        db = FakeSchemaIndexDatabase(self.rows[:8])
+        ids = SchemaIndexIds(db, ['tag'], ['tag', {}], page_size=4)
+        self.assertEqual(8, len(list(ids)))
+
+    def test_count(self):
+        ids = SchemaIndexIds(FakeSchemaIndexDatabase(self.rows), ['tag'], ['tag', {}])
+        self.assertEqual(25, len(ids))
+        self.assertTrue(ids)
+        self.assertFalse(SchemaIndexIds(FakeSchemaIndexDatabase([]), ['tag'], ['tag', {}]))
+
+
+@export_date_range(lambda startdate, enddate: (startdate, enddate))
+def received_between(doc, startdate, enddate):
+    return startdate <= doc['received_on'] <= enddate
+
+
+def is_complete(doc):
+    return doc['complete']
+
+
+class FilterPushdownTest(SimpleTestCase):
+
+    def test_view_keys(self):
+        self.assertEqual({'startkey': ['tag'], 'endkey': ['tag', {}]},
+                         get_schema_index_view_keys('tag'))
+        self.assertEqual({'startkey': ['tag', '2015-01-01'], 'endkey': ['tag', {}]},
+                         get_schema_index_view_keys('tag', ('2015-01-01', None)))
+        self.assertEqual({'startkey': ['tag', '2015-01-01'], 'endkey': ['tag', '2015-02-01']},
+                         get_schema_index_view_keys('tag', ('2015-01-01', '2015-02-01')))
+
+    def test_no_range(self):
+        self.assertEqual(None, SerializableFunction(is_complete).get_export_date_range())
+        self.assertEqual(None, SerializableFunction().get_export_date_range())
+
+    def test_intersected_ranges(self):
+        filter = SerializableFunction(received_between, startdate='2015-01-01', enddate='2015-03-01')
+        filter &= SerializableFunction(is_complete)
+        filter &= SerializableFunction(received_between, startdate='2015-02-01', enddate='2015-04-01')
+        self.assertEqual(('2015-02-01', '2015-03-01'), filter.get_export_date_range())
+
+    def test_disjoint_ranges(self):
+        filter = SerializableFunction(received_between, startdate='2015-03-01', enddate='2015-04-01')
+        filter &= SerializableFunction(received_between, startdate='2015-01-01', enddate='2015-02-01')
+        self.assertEqual(('2015-03-01', '2015-03-01'), filter.get_export_date_range())
+
+    def test_config_narrows_ids(self):
+        filter = SerializableFunction(received_between, startdate='2015-01-01', enddate='2015-02-01')
+        config = ExportConfiguration(None, ['domain', 'xmlns'], filter=filter)
+        ids = config.potentially_relevant_ids
+        self.assertEqual(['domain', 'xmlns', '2015-01-01'], ids.startkey)
+        self.assertEqual(['domain', 'xmlns', '2015-02-01'], ids.endkey)
+        # the schema is still built from every doc
+        self.assertEqual(['domain', 'xmlns', {}], config.all_doc_ids.endkey)
+
+    def test_new_ids_start_at_latest(self):
+        previous = ExportSchema(index=['domain', 'xmlns'], timestamp=datetime(2015, 1, 15))
+        ids = previous.get_new_ids(FakeSchemaIndexDatabase([]), date_range=('2015-01-01', '2015-02-01'))
+        self.assertEqual(['domain', 'xmlns', '2015-01-15T00:00:00'], ids.startkey)
+        self.assertEqual(['domain', 'xmlns', '2015-02-01'], ids.endkey)
+
+
+def _is_form(doc):
+    return doc['doc_type'] == 'XFormInstance'
+
+
+def _cheap(doc):
+    return True
+
+
+def _slow(doc):
+    return True
+
+
+def _new(doc):
+    return True
+
+
+def _has_name(doc, name):
+    # only forms have a name
+    return doc['form']['name'] == name
+
+
+class CompiledFilterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.docs = [
+            {'doc_type': 'XFormInstance', 'form': {'name': 'bob' if i % 10 else 'alice'}}
+            for i in range(100)
+        ] + [{'doc_type': 'CommCareCase'}] * 5
+
+    def _compile(self, reorder_interval=10):
+        filter = SerializableFunction(_is_form) & SerializableFunction(_has_name, name='alice')
+        compiled = filter.compile()
+        compiled.reorder_interval = reorder_interval
+        return filter, compiled
+
+    def test_same_as_serializable_function(self):
+        filter, compiled = self._compile()
+        self.assertEqual([bool(filter(doc)) for doc in self.docs],
+                         [bool(compiled(doc)) for doc in self.docs])
+
+    def test_most_selective_first(self):
+        _, compiled = self._compile()
+        for doc in self.docs[:50]:
+            compiled(doc)
+        self.assertEqual(['_has_name', '_is_form'], [stats['name'] for stats in compiled.get_stats()])
+        stats = dict((stats['name'], stats) for stats in compiled.get_stats())
+        self.assertEqual(stats['_has_name']['calls'] - 5, stats['_has_name']['rejections'])
+
+    def test_falls_back_to_original_order(self):
+        _, compiled = self._compile()
+        for doc in self.docs[:50]:
+            compiled(doc)
+        # _has_name would raise on a case
+        self.assertFalse(compiled(self.docs[-1]))
+
+    def test_raising_function_stays_behind_its_guard(self):
+        _, compiled = self._compile()
+        for doc in self.docs[:50]:
+            compiled(doc)
+        compiled(self.docs[-1])
+        self.assertEqual(['_is_form', '_has_name'], [stats['name'] for stats in compiled.get_stats()])
+        for doc in self.docs[:50]:
+            compiled(doc)
+        self.assertEqual(['_is_form', '_has_name'], [stats['name'] for stats in compiled.get_stats()])
+        self.assertEqual(1, compiled.get_stats()[1]['errors'])
+
+    def test_uncalled_function_keeps_behind_cheap_selective_one(self):
+        compiled = CompiledFilter([(_cheap, {}), (_slow, {}), (_new, {})])
+        cheap, slow, new = compiled.predicates
+        cheap.calls, cheap.rejections, cheap.seconds = 100, 90, 0.001
+        slow.calls, slow.rejections, slow.seconds = 10, 1, 1.
+        compiled.reorder()
+        self.assertEqual(['_cheap', '_new', '_slow'], [stats['name'] for stats in compiled.get_stats()])
+
+        # with nothing to compare it to, it keeps its place
+        compiled = CompiledFilter([(_cheap, {}), (_new, {})])
+        compiled.predicates[0].calls = 100
+        compiled.reorder()
+        self.assertEqual(['_cheap', '_new'], [stats['name'] for stats in compiled.get_stats()])
+
+    def test_nested(self):
+        filter = SerializableFunction(SerializableFunction(_is_form) & SerializableFunction(is_complete))
+        self.assertEqual(['_is_form', 'is_complete'],
+                         [stats['name'] for stats in filter.compile().get_stats()])
+
+    def test_config_filter_stats(self):
+        config = ExportConfiguration(None, ['domain', 'xmlns'], filter=SerializableFunction(_is_form))
+        for doc in self.docs:
+            config.include(doc)
+        [stats] = config.filter_stats
+        self.assertEqual((105, 5), (stats['calls'], stats['rejections']))
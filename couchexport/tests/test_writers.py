@@ -1,6 +1,13 @@
 # coding: utf-8
 from codecs import BOM_UTF8
-from couchexport.writers import ZippedExportWriter, CsvFileWriter
+import tempfile
+import zipfile
+from couchexport.writers import ZippedExportWriter, CsvFileWriter, StreamingExcel2007ExportWriter, \
+    JsonExportWriter, StreamingJsonExportWriter, NdjsonExportWriter, CsvExportWriter, \
+    StreamingCsvExportWriter, CompiledHtmlExportTemplate, ParquetExportWriter, ArrowExportWriter, \
+    SqliteExportWriter, UniqueHeaderGenerator, UnzippedCsvExportWriter, HtmlExportWriter, InMemoryExportWriter, \
+    TeeExportWriter
+from unittest import skipIf
 from django.test import SimpleTestCase
 from mock import patch, Mock
 
@@ -11,8 +18,9 @@ class ZippedExportWriterTests(SimpleTestCase):
         self.zip_file_patch = patch('zipfile.ZipFile')
         self.MockZipFile = self.zip_file_patch.start()
 
+        self.table_file = tempfile.NamedTemporaryFile()
         self.path_mock = Mock()
-        self.path_mock.get_path.return_value = 'tmp'
+        self.path_mock.get_path.return_value = self.table_file.name
 
         self.writer = ZippedExportWriter()
         self.writer.tables = [self.path_mock]
@@ -20,19 +28,24 @@ class ZippedExportWriterTests(SimpleTestCase):
 
     def tearDown(self):
         self.zip_file_patch.stop()
+        self.table_file.close()
         del self.writer
 
+    def assertMemberWritten(self, mock_zip_file, name):
+        member, = [args[0] for args, _ in mock_zip_file.filelist.append.call_args_list]
+        self.assertEqual(name, member.filename)
+
     def test_zipped_export_writer_unicode(self):
         mock_zip_file = self.MockZipFile.return_value
         self.writer.table_names = {0: u'ひらがな'}
         self.writer._write_final_result()
-        mock_zip_file.write.assert_called_with('tmp', 'ひらがな.csv')
+        self.assertMemberWritten(mock_zip_file, 'ひらがな.csv')
 
     def test_zipped_export_writer_utf8(self):
         mock_zip_file = self.MockZipFile.return_value
         self.writer.table_names = {0: '\xe3\x81\xb2\xe3\x82\x89\xe3\x81\x8c\xe3\x81\xaa'}
         self.writer._write_final_result()
-        mock_zip_file.write.assert_called_with('tmp', 'ひらがな.csv')
+        self.assertMemberWritten(mock_zip_file, 'ひらがな.csv')
 
 
 class CsvFileWriterTests(SimpleTestCase):
@@ -48,3 +61,388 @@ class CsvFileWriterTests(SimpleTestCase):
         writer.finish()
         file_start = writer.get_file().read(6)
         self.assertEqual(file_start, BOM_UTF8 + 'ham')
+
+
+class StreamingExcel2007ExportWriterTests(SimpleTestCase):
+
+    def _export(self, tables):
+        from cStringIO import StringIO
+        import openpyxl
+        file = StringIO()
+        writer = StreamingExcel2007ExportWriter()
+        writer.open([(index, [headers]) for index, (headers, _) in tables],
+                    file, table_titles={'a': u'ひらがな/a long name that gets truncated to 31'})
+        for index, (_, rows) in tables:
+            for row in rows:
+                writer.write_row(index, row)
+        writer.close()
+        return openpyxl.load_workbook(file)
+
+    def test_values(self):
+        book = self._export([
+            ('a', (['id', 'name', 'count'], [
+                ['0', u'Ünïcode & <xml>', 3],
+                ['1', ' spaced ', 1.5],
+                ['2', None, True],
+                ['3', 'bad\x01char', ''],
+            ])),
+        ])
+        sheet, = book.worksheets
+        self.assertEqual(u' name that gets truncated to 31', sheet.title)
+        self.assertEqual([
+            ['id', 'name', 'count'],
+            ['0', u'Ünïcode & <xml>', 3],
+            ['1', ' spaced ', 1.5],
+            ['2', None, True],
+            ['3', 'bad?char', None],
+        ], [[cell.value for cell in row] for row in sheet.iter_rows()])
+
+    def test_non_finite_floats(self):
+        from couchexport.writers import xlsx_cell
+        for value in (float('inf'), float('-inf'), float('nan')):
+            self.assertIn('t="inlineStr"', xlsx_cell('A1', value))
+        book = self._export([
+            ('a', (['id', 'value'], [['0', float('inf')], ['1', float('nan')], ['2', 0.25]])),
+        ])
+        sheet, = book.worksheets
+        self.assertEqual([['id', 'value'], ['0', 'inf'], ['1', 'nan'], ['2', 0.25]],
+                         [[cell.value for cell in row] for row in sheet.iter_rows()])
+
+    def test_sheet_order_and_wide_rows(self):
+        headers = ['h%d' % i for i in range(30)]
+        book = self._export([
+            ('b', (headers, [range(30)])),
+            ('c', (['x'], [])),
+        ])
+        self.assertEqual(['b', 'c'], book.sheetnames)
+        sheet = book['b']
+        self.assertEqual(29, sheet['AD2'].value)
+        self.assertEqual('h26', sheet['AA1'].value)
+
+
+class JsonExportWriterTests(SimpleTestCase):
+
+    tables = [
+        ('a', [['id', 'name'], ['0', u'ひらがな'], ['1', None]]),
+        ('b', [['id', 'never'], ['0.0', None]]),
+        ('c', [['id']]),
+    ]
+
+    def _export(self, writer_class):
+        from cStringIO import StringIO
+        from couchexport.export import Constant
+        file = StringIO()
+        writer = writer_class()
+        writer.open([(index, rows[:1]) for index, rows in self.tables], file)
+        for index, rows in self.tables:
+            for row in rows[1:]:
+                writer.write_row(index, [Constant('---') if value is None else value
+                                         for value in row])
+        writer.close()
+        return file.getvalue()
+
+    def test_streaming_json_matches_in_memory(self):
+        self.assertEqual(self._export(JsonExportWriter), self._export(StreamingJsonExportWriter))
+        # enough tables that their order in a dict isn't the order they came in
+        self.tables = [('t%d' % i, [['id'], [str(i)]]) for i in range(20)]
+        self.assertEqual(self._export(JsonExportWriter), self._export(StreamingJsonExportWriter))
+
+    def test_ndjson(self):
+        lines = self._export(NdjsonExportWriter).splitlines()
+        self.assertEqual([
+            '{"table": "a", "row": {"id": "0", "name": "\\u3072\\u3089\\u304c\\u306a"}}',
+            '{"table": "a", "row": {"id": "1", "name": "---"}}',
+            '{"table": "b", "row": {"id": "0.0", "never": "---"}}',
+        ], lines)
+
+
+class StreamingCsvExportWriterTests(SimpleTestCase):
+
+    def _export(self, writer_class, tables):
+        from cStringIO import StringIO
+        file = StringIO()
+        writer = writer_class()
+        writer.open([(index, rows[:1]) for index, rows in tables], file)
+        # interleave the tables' rows like a multi-table export does
+        for i in range(1, max(len(rows) for _, rows in tables)):
+            for index, rows in tables:
+                if i < len(rows):
+                    writer.write_row(index, rows[i])
+        writer.close()
+        archive = zipfile.ZipFile(file)
+        self.assertEqual(None, archive.testzip())
+        return dict((name, archive.read(name)) for name in archive.namelist())
+
+    def test_matches_zipped_csv(self):
+        tables = [
+            ('a', [['id', 'name']] + [[str(i), u'ひらがな %d' % i] for i in range(1000)]),
+            (u'ひらがな', [['id', 'x']] + [[str(i), i] for i in range(10)]),
+            ('c', [['id']]),
+        ]
+        self.assertEqual(self._export(CsvExportWriter, tables),
+                         self._export(StreamingCsvExportWriter, tables))
+
+
+class ZippedExportWriterCompressionTests(SimpleTestCase):
+
+    def _export(self, **kwargs):
+        from cStringIO import StringIO
+        file = StringIO()
+        writer = CsvExportWriter(**kwargs)
+        writer.open([('t%d' % i, [['id', 'value']]) for i in range(8)], file)
+        for i in range(8):
+            for j in range(500):
+                writer.write_row('t%d' % i, [str(j), 'table %d row %d' % (i, j)])
+        writer.close()
+        return zipfile.ZipFile(file)
+
+    def test_parallel_matches_serial(self):
+        serial = self._export(compression_workers=1)
+        parallel = self._export(compression_workers=4)
+        self.assertEqual(serial.namelist(), parallel.namelist())
+        for name in serial.namelist():
+            self.assertEqual(serial.read(name), parallel.read(name))
+
+    def test_store_only(self):
+        archive = self._export(compression_level=0)
+        self.assertEqual(None, archive.testzip())
+        self.assertEqual(set([zipfile.ZIP_STORED]),
+                         set(info.compress_type for info in archive.infolist()))
+
+    def test_get_writer_compression_levels(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from couchexport.export import get_writer
+        from couchexport.models import Format
+        with self.settings(COUCHEXPORT_COMPRESSION_LEVELS={Format.CSV: 0}):
+            self.assertEqual(0, get_writer(Format.CSV).compression_level)
+            self.assertIsInstance(get_writer(Format.XLS_2007), StreamingExcel2007ExportWriter)
+        with self.settings(COUCHEXPORT_COMPRESSION_LEVELS={Format.XLS_2007: 0}):
+            with self.assertRaises(ImproperlyConfigured):
+                get_writer(Format.XLS_2007)
+
+
+class CompiledHtmlExportTemplateTests(SimpleTestCase):
+
+    def test_matches_template(self):
+        from datetime import date
+        from django.template import Context
+        from django.template.loader import get_template
+        from couchexport.export import Constant
+        template = get_template("couchexport/html_export.html")
+        compiled = CompiledHtmlExportTemplate()
+        rows = [
+            [],
+            ['plain'],
+            [u'ひらがな', '\xe3\x81\xb2', '<b>"quoted" & \'single\'</b>'],
+            [0, 1.5, None, True, Constant('---'), date(2015, 1, 1), 0.0, -0.0, 1, 1L],
+        ]
+        contexts = [{"section": section} for section in
+                    ("doc_begin", "no_rows", "table_end", "doc_end")]
+        contexts += [{"section": "table_begin", "name": name} for name in ('a', u'<ひ>')]
+        contexts += [{"section": section, "row": row}
+                     for section in ("first_row", "row") for row in rows]
+        for context in contexts:
+            self.assertEqual(template.render(Context(context)), compiled.render(context))
+
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+@skipIf(pyarrow is None, "pyarrow isn't installed")
+class ColumnarExportWriterTests(SimpleTestCase):
+
+    def _export(self, writer):
+        from cStringIO import StringIO
+        from couchexport.export import Constant
+        file = StringIO()
+        writer.open([('a', [['id', 'name']]), ('b', [['id', u'ひらがな']])], file)
+        for i in range(25):
+            writer.write_row('a', [str(i), u'name %d' % i if i % 2 else None])
+            writer.write_row('b', ['%d.0' % i, Constant('---')])
+        writer.close()
+        return zipfile.ZipFile(file)
+
+    def test_parquet(self):
+        import pyarrow.parquet
+        archive = self._export(ParquetExportWriter(row_group_size=10))
+        self.assertEqual(['a.parquet', 'b.parquet'], archive.namelist())
+        parquet_file = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(archive.read('a.parquet')))
+        self.assertEqual(3, parquet_file.num_row_groups)
+        table = parquet_file.read().to_pydict()
+        self.assertEqual([str(i) for i in range(25)], table['id'])
+        self.assertEqual([u'name %d' % i if i % 2 else None for i in range(25)], table['name'])
+
+    def test_arrow_memory_ceiling(self):
+        archive = self._export(ArrowExportWriter(max_buffer_size=50))
+        reader = pyarrow.ipc.open_file(pyarrow.BufferReader(archive.read('b.arrow')))
+        self.assertTrue(reader.num_record_batches > 1)
+        table = reader.read_all()
+        self.assertEqual(u'ひらがな', table.schema[1].name.decode('utf-8'))
+        self.assertEqual([u'---'] * 25, table.column(1).to_pylist())
+
+    def test_zip_compression(self):
+        arrow = self._export(ArrowExportWriter())
+        self.assertEqual(set([zipfile.ZIP_DEFLATED]),
+                         set(info.compress_type for info in arrow.infolist()))
+        parquet = self._export(ParquetExportWriter())
+        self.assertEqual(set([zipfile.ZIP_STORED]),
+                         set(info.compress_type for info in parquet.infolist()))
+
+    def test_table_files_removed_on_failure(self):
+        import os
+        from cStringIO import StringIO
+        writer = ArrowExportWriter()
+        writer.open([('a', [['id']]), ('b', [['id']])], StringIO())
+        writer.write_row('a', ['1'])
+        paths = [table.path for table in writer.tables.values()]
+        with patch.object(ArrowExportWriter, '_write_batch', side_effect=IOError):
+            with self.assertRaises(IOError):
+                writer.close()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+class SqliteExportWriterTests(SimpleTestCase):
+
+    def test_tables_and_indexes(self):
+        import sqlite3
+        from couchexport.export import FormattedRow
+        file = tempfile.NamedTemporaryFile()
+        writer = SqliteExportWriter(batch_size=2)
+        writer.open([
+            ('#', [FormattedRow(['name', 'Name'], ['id'], is_header_row=True)]),
+            ('#.children', [FormattedRow(['age'], ['id', 'id__0', 'id__1'], is_header_row=True)]),
+        ], file)
+        for i in range(3):
+            writer.write([
+                ('#', [FormattedRow([u'ひらがな', None], (i,))]),
+                ('#.children', [FormattedRow([j], (i, j)) for j in range(2)]),
+            ])
+        writer.close()
+
+        db = sqlite3.connect(file.name)
+        self.assertEqual([(u'0', u'ひらがな', None), (u'1', u'ひらがな', None), (u'2', u'ひらがな', None)],
+                         db.execute('SELECT * FROM "#"').fetchall())
+        self.assertEqual([u'id', u'name', u'Name1'],
+                         [column[1] for column in db.execute('PRAGMA table_info("#")')])
+        self.assertEqual(6, db.execute(
+            'SELECT COUNT(*) FROM "#" JOIN "#.children" ON "#".id = "#.children".id__0'
+        ).fetchone()[0])
+        self.assertEqual(
+            [u'ix_#.children_id', u'ix_#.children_id__0', u'ix_#.children_id__1', u'ix_#_id'],
+            sorted(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        )
+
+    def test_database_removed_on_failure(self):
+        import os
+        from cStringIO import StringIO
+        for batch_size in (1, 10):
+            writer = SqliteExportWriter(batch_size=batch_size)
+            writer.open([('t', [['id', 'value']])], StringIO())
+            path = writer.path
+            with self.assertRaises(OverflowError):
+                # too big for an SQLite integer
+                writer.write_row('t', ['0', 2 ** 64])
+                writer.close()
+            self.assertFalse(os.path.exists(path))
+
+
+class UniqueHeaderGeneratorTests(SimpleTestCase):
+
+    @staticmethod
+    def _reference_names(headers, max_column_size):
+        # what UniqueHeaderGenerator did before it remembered its counters
+        used = set()
+        names = []
+        for string in headers:
+            counter = 1
+            if len(string) > max_column_size:
+                string = string[-max_column_size:]
+            orig_string = string
+            while string in used:
+                string = "%s%s" % (orig_string, counter)
+                if len(string) > max_column_size:
+                    counterlen = len(str(counter))
+                    string = "%s%s" % (orig_string[-(max_column_size - counterlen):], counter)
+                counter += 1
+            used.add(string)
+            names.append(string)
+        return names
+
+    def test_same_names(self):
+        import random
+        random.seed(0)
+        # short names that collide with each other's truncated and numbered forms
+        headers = [''.join(random.choice('ab1') for _ in range(random.randint(1, 8)))
+                   for _ in range(3000)]
+        for max_column_size in (3, 5, 2000):
+            generator = UniqueHeaderGenerator(max_column_size)
+            self.assertEqual(self._reference_names(headers, max_column_size),
+                             [generator.next_unique(header) for header in headers])
+
+    def test_many_colliding_headers(self):
+        # this took minutes when every collision counted up from 1
+        generator = UniqueHeaderGenerator(2000)
+        headers = ['x' * 1000 + 'shared suffix' * 100 for _ in range(50000)]
+        names = [generator.next_unique(header) for header in headers]
+        self.assertEqual(50000, len(set(names)))
+        self.assertTrue(all(len(name) <= 2000 for name in names))
+
+
+class WriteRowsTests(SimpleTestCase):
+
+    def _export(self, writer_class, batched):
+        from couchexport.export import FormattedRow
+        file = tempfile.TemporaryFile()
+        writer = writer_class()
+        writer.open([('a', [FormattedRow(['name'], ['id'], is_header_row=True)])], file)
+        rows = [FormattedRow([u'ひらがな <%d>' % i], (i,)) for i in range(5)]
+        if batched:
+            writer.write_rows('a', rows)
+        else:
+            for row in rows:
+                writer.write_row('a', row)
+        writer.close()
+        file.seek(0)
+        return file.read()
+
+    def test_same_output(self):
+        for writer_class in (UnzippedCsvExportWriter, HtmlExportWriter):
+            self.assertEqual(self._export(writer_class, batched=False),
+                             self._export(writer_class, batched=True))
+
+    def test_write_batches_tables(self):
+        from couchexport.export import FormattedRow
+        writer = InMemoryExportWriter()
+        writer.open([('a', [['id']]), ('b', [['id']])], None)
+        with patch.object(writer, '_write_rows', wraps=writer._write_rows) as write_rows:
+            writer.write([
+                ('a', [FormattedRow([], (0,)), FormattedRow([], (0,))]),
+                ('b', [FormattedRow([], (0, 0))]),
+            ])
+            self.assertEqual(2, write_rows.call_count)
+        self.assertEqual([['id'], ['0'], ['0']], writer.tables['a'])
+
+
+class TeeExportWriterTests(SimpleTestCase):
+
+    def _export(self, writer, files):
+        from couchexport.export import FormattedRow
+        headers = (table for table in [('a', [FormattedRow(['name'], ['id'], is_header_row=True)])])
+        writer.open(headers, files)
+        for i in range(3):
+            writer.write([('a', (row for row in [FormattedRow([u'ひらがな %d' % i], (0,))]))])
+        writer.close()
+
+    def test_same_as_separate_writers(self):
+        from cStringIO import StringIO
+        expected = []
+        for writer_class in (UnzippedCsvExportWriter, StreamingJsonExportWriter):
+            file = StringIO()
+            self._export(writer_class(), file)
+            expected.append(file.getvalue())
+        files = [StringIO(), StringIO()]
+        self._export(TeeExportWriter([UnzippedCsvExportWriter(), StreamingJsonExportWriter()]), files)
+        self.assertEqual(expected, [f.getvalue() for f in files])
@@ -1,14 +1,87 @@
 import datetime
+from couchexport.util import SerializableFunction, parse_iso_datetime
 
 COUCH_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ']
 EXCEL_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
+def value_pure(fn):
+    """
+    Declare that a transform's result only depends on the value (and the
+    transform's kwargs), not on the doc, so exports can remember it for
+    values they've already seen.
+    """
+    fn.value_pure = True
+    return fn
+
+
+def batch_transform(transform_many):
+    """
+    Give a transform a version that does a whole slice of a column at once.
+
+    transform_many(vals, doc, **kwargs) returns the list of transformed vals
+    and must give the same results as calling the transform on each one.
+
+    @batch_transform(lambda vals, doc: [val.upper() for val in vals])
+    def upper(val, doc):
+        return val.upper()
+    """
+    def decorator(fn):
+        fn.transform_many = transform_many
+        return fn
+    return decorator
+
+
+def _get_functions(transform):
+    if isinstance(transform, SerializableFunction):
+        return transform.functions
+    return [(transform, {})] if transform else []
+
+
+def is_value_pure(transform):
+    """
+    Whether every function a (Serializable) transform calls is value_pure
+    """
+    functions = _get_functions(transform)
+    return bool(functions) and all(getattr(f, 'value_pure', False) for f, _ in functions)
+
+
+def get_transform_many(transform):
+    """
+    The batch version of a (Serializable) transform made of a single
+    function with a batch_transform, or None
+    """
+    functions = _get_functions(transform)
+    if len(functions) != 1:
+        return None
+    (f, f_kwargs), = functions
+    transform_many = getattr(f, 'transform_many', None)
+    if transform_many is None:
+        return None
+
+    def fn(vals, doc):
+        return transform_many(vals, doc, **f_kwargs)
+    return fn
+
+
 def identity(val, doc):
     return val
 
 
+@value_pure
 def couch_to_excel_datetime(val, doc):
+    if isinstance(val, basestring):
+        parsed = parse_iso_datetime(val)
+        if parsed:
+            # only the Z forms are converted, and strftime can't do years before 1900
+            if parsed[1] == 'Z' and parsed[0].year >= 1900:
+                # the date and time parts are already in EXCEL_FORMAT
+                return str(val[:10]) + ' ' + str(val[11:19])
+            return val
+    return _couch_to_excel_datetime_strptime(val, doc)
+
+
+def _couch_to_excel_datetime_strptime(val, doc):
     if isinstance(val, basestring):
         # todo: subtree merge couchexport into commcare-hq
         # todo: and replace this with iso_string_to_datetime
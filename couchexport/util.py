@@ -1,6 +1,9 @@
+from collections import OrderedDict
+import datetime
 import functools
 from inspect import isfunction
 import json
+import time
 from dimagi.ext.couchdbkit import Property
 from dimagi.utils.modules import to_function
 from dimagi.utils.web import json_handler
@@ -13,13 +16,201 @@ def force_tag_to_list(export_tag):
     return export_tag
 
 
-def get_schema_index_view_keys(export_tag):
+def get_schema_index_view_keys(export_tag, date_range=None):
     """
-    Get the view start and end keys to query the schema_index view
+    Get the view start and end keys to query the schema_index view,
+    optionally narrowed to a (start, end) range of export dates
     """
     export_tag = force_tag_to_list(export_tag)
-    return {'startkey': export_tag,
-            'endkey': export_tag + [{}]}
+    start, end = date_range or (None, None)
+    return {'startkey': export_tag + [start] if start else export_tag,
+            'endkey': export_tag + [end] if end else export_tag + [{}]}
+
+
+def export_date_range(get_range):
+    """
+    Declare that a filter function only accepts docs whose export date (the
+    last part of their schema_index key) is in a certain range, so the docs
+    outside it don't have to be fetched at all.
+
+    get_range is called with the filter's kwargs and returns an inclusive
+    (start, end) pair of ISO date strings, either of which can be None.
+    The range must include every export date the filter could accept.
+
+    @export_date_range(lambda startdate, enddate: (startdate, enddate + 'T23:59:59.999999Z'))
+    def received_between(doc, startdate, enddate):
+        ...
+    """
+    def decorator(fn):
+        fn.export_date_range = get_range
+        return fn
+    return decorator
+
+
+def _isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def intersect_date_ranges(ranges):
+    """
+    The (start, end) range common to all the given ranges,
+    or None if there are none
+    """
+    ranges = list(ranges)
+    if not ranges:
+        return None
+    starts = [_isoformat(start) for start, _ in ranges if start]
+    ends = [_isoformat(end) for _, end in ranges if end]
+    start = max(starts) if starts else None
+    end = min(ends) if ends else None
+    if start and end and end < start:
+        # couch rejects reversed key ranges; the filters reject what's left
+        end = start
+    return start, end
+
+
+def get_export_date_range(filter):
+    """
+    The range of export dates a filter (plain function or
+    SerializableFunction) declares it restricts docs to, if any
+    """
+    if isinstance(filter, SerializableFunction):
+        return filter.get_export_date_range()
+    get_range = getattr(filter, 'export_date_range', None)
+    return intersect_date_ranges([get_range()]) if get_range else None
+
+
+_DIGITS = '0123456789'
+
+
+def parse_iso_datetime(value):
+    """
+    Quickly parse the fixed ISO 8601 shapes couch timestamps come in:
+    YYYY-MM-DDTHH:MM:SS, optionally with 1-6 digits of fractional seconds,
+    and optionally ending in Z or a +HH:MM/-HH:MM offset.
+
+    Returns (naive datetime, zone) with zone '', 'Z' or the offset, or None
+    if the value isn't one of these shapes or isn't a valid date, so callers
+    can fall back to a general parser. The offset is not applied.
+
+    >>> parse_iso_datetime('2013-01-03T11:27:06.045Z')
+    (datetime.datetime(2013, 1, 3, 11, 27, 6, 45000), 'Z')
+    """
+    if (len(value) < 19 or value[4] != '-' or value[7] != '-' or value[10] != 'T'
+            or value[13] != ':' or value[16] != ':'):
+        return None
+    fields = (value[0:4], value[5:7], value[8:10], value[11:13], value[14:16], value[17:19])
+    if ''.join(fields).strip(_DIGITS):
+        return None
+
+    zone = value[19:]
+    microsecond = 0
+    if zone[:1] == '.':
+        end = 1
+        while end < len(zone) and zone[end] in _DIGITS:
+            end += 1
+        if not 1 < end <= 7:
+            return None
+        microsecond = int(zone[1:end].ljust(6, '0'))
+        zone = zone[end:]
+    if zone and zone != 'Z' and not (
+            len(zone) == 6 and zone[0] in '+-' and zone[3] == ':'
+            and not (zone[1:3] + zone[4:6]).strip(_DIGITS)):
+        return None
+
+    try:
+        year, month, day, hour, minute, second = map(int, fields)
+        return datetime.datetime(year, month, day, hour, minute, second, microsecond), zone
+    except ValueError:
+        return None
+
+
+class SchemaIndexIds(object):
+    """
+    The ids of the docs in a key range of the schema_index view.
+
+    Iterating pages through the view with startkey/startkey_docid so only
+    one page of rows is held in memory at a time. len() counts the ids with
+    the view's _count reduce instead of fetching them.
+    """
+    view_name = "couchexport/schema_index"
+
+    def __init__(self, database, startkey, endkey, page_size=1000):
+        self.database = database
+        self.startkey = startkey
+        self.endkey = endkey
+        self.page_size = page_size
+        self._count = None
+
+    def _view(self, **params):
+        return self.database.view(self.view_name, endkey=self.endkey, **params)
+
+    def _iter_rows(self, page_size, **extra):
+        params = {'startkey': self.startkey}
+        while True:
+            rows = self._view(reduce=False, limit=page_size, **dict(params, **extra)).all()
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            # start the next page right after the last row of this one
+            params = {
+                'startkey': rows[-1]['key'],
+                'startkey_docid': rows[-1]['id'],
+                'skip': 1,
+            }
+
+    def __iter__(self):
+        for row in self._iter_rows(self.page_size):
+            yield row['id']
+
+    def iter_docs(self, page_size=None):
+        """
+        The docs themselves, fetched with the view's include_docs a page
+        at a time, for when only the first few are wanted
+        """
+        for row in self._iter_rows(page_size or self.page_size, include_docs=True):
+            yield row['doc']
+
+    def __len__(self):
+        if self._count is None:
+            result = self._view(reduce=True, startkey=self.startkey).one()
+            self._count = result['value'] if result else 0
+        return self._count
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most `max_size` items,
+    dropping the least recently used one when it's full
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        if len(self._items) >= self.max_size:
+            self._items.popitem(last=False)
+        self._items[key] = value
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
 
 
 def intersect_functions(*functions):
@@ -97,6 +288,23 @@ class SerializableFunction(object):
         else:
             return True
 
+    def compile(self):
+        """
+        A CompiledFilter doing the same as calling this
+        """
+        return CompiledFilter(self.functions)
+
+    def get_export_date_range(self):
+        """
+        The range of export dates the functions declared with
+        export_date_range restrict docs to, or None
+        """
+        return intersect_date_ranges(
+            f.export_date_range(**f_kwargs)
+            for (f, f_kwargs) in self.functions
+            if getattr(f, 'export_date_range', None)
+        )
+
     def dumps_simple(self):
         (f, kwargs), = self.functions
         assert not kwargs
@@ -157,6 +365,136 @@ class SerializableFunction(object):
 FilterFunction = SerializableFunction
 
 
+class FilterPredicate(object):
+    """
+    One of the functions of a CompiledFilter, with what it has
+    cost, rejected and raised on so far
+    """
+
+    def __init__(self, function, kwargs):
+        self.function = function
+        self.kwargs = kwargs
+        self.call = functools.partial(function, **kwargs) if kwargs else function
+        self.calls = 0
+        self.rejections = 0
+        self.errors = 0
+        self.seconds = 0.
+
+    @property
+    def name(self):
+        return getattr(self.function, '__name__', repr(self.function))
+
+    @property
+    def rank(self):
+        """
+        Expected cost of running it per doc it rejects; lower runs earlier.
+        One that has raised runs last, in case an earlier function guards it,
+        and one that hasn't run yet has no rank (None).
+        """
+        if self.errors:
+            return float('inf')
+        if not self.calls:
+            return None
+        if not self.rejections:
+            return float('inf')
+        return self.seconds / self.rejections
+
+    def get_stats(self):
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'rejections': self.rejections,
+            'errors': self.errors,
+            'seconds': self.seconds,
+        }
+
+
+class CompiledFilter(object):
+    """
+    The functions of a SerializableFunction (including those of nested
+    SerializableFunctions) compiled once into a flat filter for an export.
+
+    Every call records how long each function took and whether it rejected
+    the doc, and every `reorder_interval` docs the functions are reordered
+    so that the ones that reject the most docs for what they cost run first.
+
+    The result is only meant to be used for its truth value: the functions
+    are assumed to be side-effect free, so they commute. If one raises when
+    run out of its original order the doc is filtered again in that order,
+    in case an earlier function was guarding against it, and from then on
+    it runs behind every function that was ahead of it originally.
+    """
+    reorder_interval = 1000
+
+    def __init__(self, functions):
+        self.predicates = [FilterPredicate(f, kwargs) for f, kwargs in self._flatten(functions)]
+        self.order = list(self.predicates)
+        self.reordered = False
+        self.docs = 0
+
+    @classmethod
+    def _flatten(cls, functions):
+        for f, kwargs in functions:
+            if isinstance(f, SerializableFunction) and not kwargs:
+                for f_, kwargs_ in cls._flatten(f.functions):
+                    yield f_, kwargs_
+            else:
+                yield f, kwargs
+
+    def __len__(self):
+        return len(self.predicates)
+
+    def __call__(self, *args, **kwargs):
+        self.docs += 1
+        if self.docs % self.reorder_interval == 0:
+            self.reorder()
+        val = True
+        for predicate in self.order:
+            start = time.time()
+            try:
+                val = predicate.call(*args, **kwargs)
+            except Exception:
+                predicate.errors += 1
+                if not self.reordered:
+                    raise
+                self.reorder()
+                return self._call_in_original_order(*args, **kwargs)
+            finally:
+                predicate.seconds += time.time() - start
+                predicate.calls += 1
+            if not val:
+                predicate.rejections += 1
+                return val
+        return val
+
+    def _call_in_original_order(self, *args, **kwargs):
+        val = True
+        for predicate in self.predicates:
+            val = predicate.call(*args, **kwargs)
+            if not val:
+                return val
+        return val
+
+    def reorder(self):
+        ranks = [predicate.rank for predicate in self.predicates]
+        # functions that haven't run yet get the mean of the measured ranks
+        # (or go last, with those that never reject, if nothing has a rank)
+        measured = [rank for rank in ranks if rank is not None and rank != float('inf')]
+        neutral = sum(measured) / len(measured) if measured else float('inf')
+        ranks = [neutral if rank is None else rank for rank in ranks]
+        # sorted is stable, so functions with the same rank keep their order
+        self.order = [predicate for _, predicate in sorted(
+            zip(ranks, self.predicates), key=lambda (rank, _): rank
+        )]
+        self.reordered = self.order != self.predicates
+
+    def get_stats(self):
+        """
+        What each function has cost and rejected, in the order they run
+        """
+        return [predicate.get_stats() for predicate in self.order]
+
+
 class SerializableFunctionProperty(Property):
 
     def __init__(self, verbose_name=None, name=None,
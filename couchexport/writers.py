@@ -1,12 +1,24 @@
 from codecs import BOM_UTF8
+from collections import OrderedDict
+import itertools
 import os
 import re
+import shutil
+import sqlite3
 import tempfile
+import time
 import zipfile
+import zlib
 import csv
 import json
+import math
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape, quoteattr
+from django.conf import settings
 from django.template import Context
-from django.template.loader import render_to_string, get_template
+from django.template.base import render_value_in_context
+from django.template.loader import get_template
+from django.utils.html import escape as escape_html
 import xlwt
 
 
@@ -14,6 +26,8 @@ class UniqueHeaderGenerator(object):
     def __init__(self, max_column_size=None):
         self.used = set()
         self.max_column_size = max_column_size or 2000
+        # the first counter that might still be free for each (truncated) header
+        self.counters = {}
 
     def next_unique(self, header):
         header = self._next_unique(header)
@@ -21,11 +35,15 @@ class UniqueHeaderGenerator(object):
         return header
 
     def _next_unique(self, string):
-        counter = 1
         if len(string) > self.max_column_size:
             # truncate from the beginning since the end has more specific information
             string = string[-self.max_column_size:]
         orig_string = string
+        if string not in self.used:
+            return string
+        # every name with a lower counter has been used already, and
+        # names are never unused, so there's no need to try them again
+        counter = self.counters.get(orig_string, 1)
         while string in self.used:
             string = "%s%s" % (orig_string, counter)
             if len(string) > self.max_column_size:
@@ -33,6 +51,7 @@ class UniqueHeaderGenerator(object):
                 string = "%s%s" % (orig_string[-(self.max_column_size - counterlen):], counter)
             counter += 1
 
+        self.counters[orig_string] = counter - 1
         return string
 
     def __enter__(self):
@@ -42,6 +61,10 @@ class UniqueHeaderGenerator(object):
         pass
 
 
+def encode_if_needed(val):
+    return val.encode("utf8") if isinstance(val, unicode) else val
+
+
 class ExportFileWriter(object):
 
     def __init__(self):
@@ -77,6 +100,10 @@ class ExportFileWriter(object):
     def write_row(self, row):
         raise NotImplementedError
 
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
     def _end_file(self):
         pass
 
@@ -101,14 +128,95 @@ class CsvFileWriter(ExportFileWriter):
     def write_row(self, row):
         self._csvwriter.writerow(row)
 
+    def write_rows(self, rows):
+        self._csvwriter.writerows(rows)
+
+
+class CompiledHtmlExportTemplate(object):
+    """
+    The sections of the html export template, rendered through Django
+    once each so they can be filled in without rendering the template again.
+
+    render() takes the same contexts as the template, and its output is
+    the same as rendering them. For the row sections the markup around
+    and between the cells is found by rendering rows of placeholder cells.
+    """
+    static_sections = ("doc_begin", "no_rows", "table_end", "doc_end")
+    row_sections = ("first_row", "row")
+    placeholders = (u'__couchexport_placeholder_0__', u'__couchexport_placeholder_1__')
+
+    cached_value_types = (int, long, float, bool, type(None))
+    max_cached_values = 10000
+
+    def __init__(self, template_name="couchexport/html_export.html"):
+        template = get_template(template_name)
+        self._context = Context()
+        # escape_html replaces these characters one by one
+        self._escapes = [(char, escape_html(char)) for char in u'&<>"\'' if escape_html(char) != char]
+        # rendering numbers goes through localization, which is slow
+        self._rendered_values = {}
+
+        def render(context):
+            return template.render(Context(context))
+
+        first, second = self.placeholders
+        self.sections = {}
+        for section in self.static_sections:
+            self.sections[section] = render({"section": section})
+        self.table_begin = render({"section": "table_begin", "name": first}).split(first)
+        self.rows = {}
+        for section in self.row_sections:
+            no_cells = render({"section": section, "row": []})
+            head, tail = render({"section": section, "row": [first]}).split(first)
+            between = render({"section": section, "row": [first, second]}).split(first)[1].split(second)[0]
+            self.rows[section] = (no_cells, head, between, tail)
+
+    def _escape(self, value):
+        for char, escaped in self._escapes:
+            if char in value:
+                value = value.replace(char, escaped)
+        return value
+
+    def render_value(self, value):
+        value_type = type(value)
+        if value_type is unicode:
+            return self._escape(value)
+        if value_type is str:
+            return self._escape(value.decode('utf-8'))
+        if value_type in self.cached_value_types:
+            # repr tells 0.0 and -0.0 apart
+            key = (value_type, repr(value) if value_type is float else value)
+            try:
+                return self._rendered_values[key]
+            except KeyError:
+                rendered = render_value_in_context(value, self._context)
+                if len(self._rendered_values) < self.max_cached_values:
+                    self._rendered_values[key] = rendered
+                return rendered
+        return render_value_in_context(value, self._context)
+
+    def render_row(self, section, row):
+        no_cells, head, between, tail = self.rows[section]
+        if not row:
+            return no_cells
+        return head + between.join(map(self.render_value, row)) + tail
+
+    def render(self, context):
+        section = context["section"]
+        if section in self.rows:
+            return self.render_row(section, context["row"])
+        if section == "table_begin":
+            return self.render_value(context["name"]).join(self.table_begin)
+        return self.sections[section]
+
 
 class PartialHtmlFileWriter(ExportFileWriter):
 
     def _write_from_template(self, context):
-        self._file.write(self.template.render(Context(context)).encode('utf-8'))
+        self._file.write(self.template.render(context).encode('utf-8'))
 
     def _open(self):
-        self.template = get_template("couchexport/html_export.html")
+        self.template = CompiledHtmlExportTemplate()
         self._on_first_row = True
 
     def write_row(self, row):
@@ -116,6 +224,14 @@ class PartialHtmlFileWriter(ExportFileWriter):
         self._on_first_row = False
         self._write_from_template({"row": row, "section": section})
 
+    def write_rows(self, rows):
+        rendered = []
+        for row in rows:
+            section = "row" if not self._on_first_row else "first_row"
+            self._on_first_row = False
+            rendered.append(self.template.render_row(section, row))
+        self._file.write(u''.join(rendered).encode('utf-8'))
+
     def _end_file(self):
         if self._on_first_row:
             # There were no rows
@@ -136,6 +252,8 @@ class HtmlFileWriter(PartialHtmlFileWriter):
 
 class ExportWriter(object):
     max_table_name_size = 500
+    # whether __init__ takes a zlib compression_level
+    accepts_compression_level = False
 
     def open(self, header_table, file, max_column_size=2000, table_titles=None):
         """
@@ -184,6 +302,7 @@ class ExportWriter(object):
         """
         assert self._isopen
         for table_index, table in document_table:
+            rows = []
             for i, row in enumerate(table):
                 if skip_first and i is 0:
                     continue
@@ -195,8 +314,9 @@ class ExportWriter(object):
                     row_has_id = False
                 if row_has_id:
                     row.id = (self._current_primary_id,) + tuple(row.id[1:])
+                rows.append(row)
 
-                self.write_row(table_index, row)
+            self.write_rows(table_index, rows)
 
         self._current_primary_id += 1
 
@@ -208,6 +328,13 @@ class ExportWriter(object):
         """
         return self._write_row(table_index, headers)
 
+    def write_rows(self, table_index, rows):
+        """
+        Write several rows to a table at once, which writers
+        can do with less overhead than one at a time.
+        """
+        return self._write_rows(table_index, rows)
+
     def close(self):
         """
         Close any open file references, do any cleanup.
@@ -225,6 +352,10 @@ class ExportWriter(object):
     def _write_row(self, sheet_index, row):
         raise NotImplementedError
 
+    def _write_rows(self, sheet_index, rows):
+        for row in rows:
+            self._write_row(sheet_index, row)
+
     def _close(self):
         raise NotImplementedError
 
@@ -258,12 +389,12 @@ class OnDiskExportWriter(ExportWriter):
         self.table_names[table_index] = table_title
 
     def _write_row(self, sheet_index, row):
+        self._write_rows(sheet_index, [row])
 
-        def _encode_if_needed(val):
-            return val.encode("utf8") if isinstance(val, unicode) else val
-        row = map(_encode_if_needed, self.get_data(row))
-
-        self.tables[sheet_index].write_row(row)
+    def _write_rows(self, sheet_index, rows):
+        self.tables[sheet_index].write_rows([
+            map(encode_if_needed, self.get_data(row)) for row in rows
+        ])
 
     def _close(self):
         """
@@ -287,17 +418,45 @@ class OnDiskExportWriter(ExportWriter):
 class ZippedExportWriter(OnDiskExportWriter):
     """
     Writer that creates a zip file containing a csv for each table.
+
+    The tables are compressed concurrently by `compression_workers`
+    threads, at `compression_level` (0 stores them uncompressed).
     """
     table_file_extension = ".csv"
+    accepts_compression_level = True
+
+    def __init__(self, compression_level=None, compression_workers=None):
+        self.compression_level = compression_level if compression_level is not None \
+            else zlib.Z_DEFAULT_COMPRESSION
+        self.compression_workers = compression_workers or \
+            getattr(settings, 'COUCHEXPORT_COMPRESSION_WORKERS', 4)
 
     def _write_final_result(self):
 
-        archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
-        for index, name in self.table_names.items():
+        archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+        def compress(index):
+            name = self.table_names[index]
             if isinstance(name, unicode):
                 name = name.encode('utf-8')
-            path = self.tables[index].get_path()
-            archive.write(path, "{}{}".format(name, self.table_file_extension))
+            member = ZipMember(archive, "{}{}".format(name, self.table_file_extension),
+                               compresslevel=self.compression_level)
+            member.write_file(self.tables[index].get_path())
+            return member
+
+        indices = self.table_names.keys()
+        workers = min(self.compression_workers, len(indices))
+        if workers > 1:
+            # zlib releases the GIL while it compresses
+            pool = ThreadPool(workers)
+            try:
+                members = pool.map(compress, indices)
+            finally:
+                pool.close()
+        else:
+            members = map(compress, indices)
+        for member in members:
+            member.finish()
         archive.close()
         self.file.seek(0)
 
@@ -322,6 +481,121 @@ class UnzippedCsvExportWriter(OnDiskExportWriter):
         self.file.seek(0)
 
 
+class ZipMember(object):
+    """
+    A member of a zip archive that's compressed as it's written, with
+    `compresslevel` 0 meaning it's stored uncompressed.
+
+    If `stream` is set the compressed data goes straight into the
+    archive, which it must be the last thing written to until it's
+    finished. Otherwise it's kept in a temporary file and copied into the
+    archive as is when the member is finished.
+    """
+
+    def __init__(self, archive, name, stream=False, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+        self.archive = archive
+        self.info = zipfile.ZipInfo(name, time.localtime()[:6])
+        self.info.external_attr = 0600 << 16
+        self.info.CRC = self.info.file_size = self.info.compress_size = 0
+        if compresslevel == 0:
+            self.info.compress_type = zipfile.ZIP_STORED
+            self._compressor = None
+        else:
+            self.info.compress_type = zipfile.ZIP_DEFLATED
+            self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        self.stream = stream
+        if stream:
+            self.info.header_offset = archive.fp.tell()
+            # sizes aren't known yet, so make room for zip64 ones
+            archive.fp.write(self.info.FileHeader(zip64=True))
+            self._file = archive.fp
+        else:
+            self._file = tempfile.TemporaryFile()
+
+    def write(self, data):
+        self.info.file_size += len(data)
+        self.info.CRC = zlib.crc32(data, self.info.CRC) & 0xffffffff
+        self._write_compressed(self._compressor.compress(data) if self._compressor else data)
+
+    def write_file(self, path, chunk_size=1024 * 1024):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                self.write(chunk)
+
+    def _write_compressed(self, data):
+        self.info.compress_size += len(data)
+        self._file.write(data)
+
+    def finish(self):
+        """
+        Finish writing the member's data into the archive
+        """
+        if self._compressor:
+            self._write_compressed(self._compressor.flush())
+        fp = self.archive.fp
+        if self.stream:
+            end = fp.tell()
+            fp.seek(self.info.header_offset)
+            fp.write(self.info.FileHeader(zip64=True))
+            fp.seek(end)
+        else:
+            self.info.header_offset = fp.tell()
+            fp.write(self.info.FileHeader())
+            self._file.seek(0)
+            shutil.copyfileobj(self._file, fp)
+            self._file.close()
+        self.archive.filelist.append(self.info)
+        self.archive.NameToInfo[self.info.filename] = self.info
+        self.archive._didModify = True
+
+
+class StreamingCsvExportWriter(ExportWriter):
+    """
+    Creates a zip file containing a csv for each table like CsvExportWriter,
+    compressing rows into the zip members as they are written.
+
+    The first table is streamed straight into the zip file. The rest
+    (whose rows are interleaved with it) are compressed into temporary
+    files that are copied into the zip file at the end.
+    """
+    table_file_extension = ".csv"
+    accepts_compression_level = True
+
+    def __init__(self, compression_level=None):
+        self.compression_level = compression_level if compression_level is not None \
+            else zlib.Z_DEFAULT_COMPRESSION
+
+    def _init(self):
+        self.archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.tables = {}
+        self.table_names = {}
+        self.table_order = []
+
+    def _init_table(self, table_index, table_title):
+        name = table_title.encode('utf-8') if isinstance(table_title, unicode) else table_title
+        member = ZipMember(self.archive, "{}{}".format(name, self.table_file_extension),
+                           stream=not self.table_order, compresslevel=self.compression_level)
+        # Excel needs UTF8-encoded CSVs to start with the UTF-8 byte-order mark (FB 163268)
+        member.write(BOM_UTF8)
+        self.tables[table_index] = csv.writer(member, csv.excel)
+        self.table_names[table_index] = table_title
+        self.table_order.append((table_index, member))
+
+    def _write_row(self, sheet_index, row):
+        self._write_rows(sheet_index, [row])
+
+    def _write_rows(self, sheet_index, rows):
+        self.tables[sheet_index].writerows([
+            map(encode_if_needed, self.get_data(row)) for row in rows
+        ])
+
+    def _close(self):
+        for _, member in self.table_order:
+            member.finish()
+        self.archive.close()
+        self.file.seek(0)
+
+
 class Excel2007ExportWriter(ExportWriter):
     max_table_name_size = 31
 
@@ -345,29 +619,29 @@ class Excel2007ExportWriter(ExportWriter):
         self.table_indices[table_index] = 0
 
 
-    def _write_row(self, sheet_index, row):
-        sheet = self.tables[sheet_index]
+    @staticmethod
+    def get_write_value(value):
+        if isinstance(value, (int, long, float)):
+            return value
+        if isinstance(value, str):
+            value = unicode(value, encoding="utf-8")
+        elif value is not None:
+            value = unicode(value)
+        else:
+            value = u''
+        return XML_DIRTY_CHARS.sub(u'?', value)
 
-        # Source: http://stackoverflow.com/questions/1707890/fast-way-to-filter-illegal-xml-unicode-chars-in-python
-        dirty_chars = re.compile(
-            u'[\x00-\x08\x0b-\x1f\x7f-\x84\x86-\x9f\ud800-\udfff\ufdd0-\ufddf\ufffe-\uffff]'
-        )
-
-        def get_write_value(value):
-            if isinstance(value, (int, long, float)):
-                return value
-            if isinstance(value, str):
-                value = unicode(value, encoding="utf-8")
-            elif value is not None:
-                value = unicode(value)
-            else:
-                value = u''
-            return dirty_chars.sub(u'?', value)
+    def _write_row(self, sheet_index, row):
+        self._write_rows(sheet_index, [row])
 
-        # NOTE: don't touch this. changing anything like formatting in the
-        # row by referencing the cells will cause huge memory issues.
-        # see: http://openpyxl.readthedocs.org/en/latest/optimized.html
-        sheet.append(map(get_write_value, self.get_data(row)))
+    def _write_rows(self, sheet_index, rows):
+        sheet = self.tables[sheet_index]
+        get_write_value = self.get_write_value
+        for row in rows:
+            # NOTE: don't touch this. changing anything like formatting in the
+            # row by referencing the cells will cause huge memory issues.
+            # see: http://openpyxl.readthedocs.org/en/latest/optimized.html
+            sheet.append(map(get_write_value, self.get_data(row)))
 
     def _close(self):
         """
@@ -376,6 +650,195 @@ class Excel2007ExportWriter(ExportWriter):
         self.book.save(self.file)
 
 
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '%s</Types>'
+)
+XLSX_SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet%d.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>%s</sheets></workbook>'
+)
+XLSX_WORKBOOK_SHEET = '<sheet name=%s sheetId="%d" r:id="rId%d"/>'
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '%s<Relationship Id="rId%d" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/></Relationships>'
+)
+XLSX_WORKBOOK_SHEET_REL = (
+    '<Relationship Id="rId%d" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet%d.xml"/>'
+)
+XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '</styleSheet>'
+)
+XLSX_SHEET_BEGIN = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_END = '</sheetData></worksheet>'
+
+# Source: http://stackoverflow.com/questions/1707890/fast-way-to-filter-illegal-xml-unicode-chars-in-python
+XML_DIRTY_CHARS = re.compile(
+    u'[\x00-\x08\x0b-\x1f\x7f-\x84\x86-\x9f\ud800-\udfff\ufdd0-\ufddf\ufffe-\uffff]'
+)
+
+
+def xlsx_column_name(index):
+    """
+    The column letters of the 0-based column index: A, B, ..., Z, AA, AB, ...
+    """
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def xlsx_cell(ref, value):
+    """
+    The <c> element for a cell, with strings written inline
+    so no shared strings table has to be built
+    """
+    if isinstance(value, bool):
+        return '<c r="%s" t="b"><v>%d</v></c>' % (ref, value)
+    if isinstance(value, (int, long)):
+        return '<c r="%s"><v>%d</v></c>' % (ref, value)
+    if isinstance(value, float) and not (math.isinf(value) or math.isnan(value)):
+        return '<c r="%s"><v>%r</v></c>' % (ref, value)
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        value = unicode(value, encoding="utf-8")
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    if not value:
+        return ''
+    value = escape(XML_DIRTY_CHARS.sub(u'?', value)).encode('utf-8')
+    return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, value)
+
+
+class XlsxSheetFileWriter(ExportFileWriter):
+    """
+    Writes a table as the XML of an xlsx worksheet
+    """
+
+    def _open(self):
+        self._row_count = 0
+        self._columns = []
+
+    def _begin_file(self):
+        self._file.write(XLSX_SHEET_BEGIN)
+
+    def _row_xml(self, row):
+        self._row_count += 1
+        row_number = str(self._row_count)
+        columns = self._columns
+        if len(row) > len(columns):
+            columns.extend(xlsx_column_name(i) for i in range(len(columns), len(row)))
+        return '<row r="%s">%s</row>' % (row_number, ''.join([
+            xlsx_cell(column + row_number, value)
+            for column, value in zip(columns, row)
+        ]))
+
+    def write_row(self, row):
+        self._file.write(self._row_xml(row))
+
+    def write_rows(self, rows):
+        self._file.write(''.join(map(self._row_xml, rows)))
+
+    def _end_file(self):
+        self._file.write(XLSX_SHEET_END)
+
+
+class StreamingExcel2007ExportWriter(OnDiskExportWriter):
+    """
+    Writes xlsx files directly, without openpyxl.
+
+    Each sheet's XML is written to a temporary file as rows come in (tables
+    are written to in any order) and the files are zipped up with the rest
+    of the workbook when it's closed.
+    """
+    max_table_name_size = 31
+    writer_class = XlsxSheetFileWriter
+
+    def _init(self):
+        super(StreamingExcel2007ExportWriter, self)._init()
+        self.table_order = []
+
+    def _init_table(self, table_index, table_title):
+        super(StreamingExcel2007ExportWriter, self)._init_table(table_index, table_title)
+        self.table_order.append(table_index)
+
+    def _write_rows(self, sheet_index, rows):
+        self.tables[sheet_index].write_rows([list(self.get_data(row)) for row in rows])
+
+    def _write_final_result(self):
+        archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+        sheets = [(self.table_names[index], self.tables[index].get_path())
+                  for index in self.table_order]
+        if not sheets:
+            # a workbook needs at least one sheet
+            empty_sheet = XlsxSheetFileWriter()
+            empty_sheet.open('Sheet')
+            empty_sheet.finish()
+            sheets = [('Sheet', empty_sheet.get_path())]
+        else:
+            empty_sheet = None
+
+        numbers = range(1, len(sheets) + 1)
+        archive.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES % ''.join(
+            XLSX_SHEET_CONTENT_TYPE % n for n in numbers
+        ))
+        archive.writestr('_rels/.rels', XLSX_ROOT_RELS)
+        archive.writestr('xl/workbook.xml', XLSX_WORKBOOK % ''.join(
+            XLSX_WORKBOOK_SHEET % (quoteattr(unicode(name)).encode('utf-8'), n, n)
+            for n, (name, _) in zip(numbers, sheets)
+        ))
+        archive.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS % (
+            ''.join(XLSX_WORKBOOK_SHEET_REL % (n, n) for n in numbers),
+            len(sheets) + 1
+        ))
+        archive.writestr('xl/styles.xml', XLSX_STYLES)
+        for n, (_, path) in zip(numbers, sheets):
+            archive.write(path, 'xl/worksheets/sheet%d.xml' % n)
+        archive.close()
+        if empty_sheet:
+            empty_sheet.close()
+        self.file.seek(0)
+
+
 class Excel2003ExportWriter(ExportWriter):
     max_table_name_size = 31
 
@@ -419,6 +882,9 @@ class InMemoryExportWriter(ExportWriter):
         row_data = [val for val in self.get_data(row)]
         table.append(row_data)
 
+    def _write_rows(self, sheet_index, rows):
+        self.tables[sheet_index].extend(list(self.get_data(row)) for row in rows)
+
     def _close(self):
         pass
 
@@ -445,6 +911,99 @@ class JsonExportWriter(InMemoryExportWriter):
         self.file.write(json.dumps(new_tables, cls=self.ConstantEncoder))
 
 
+class JsonRowsFileWriter(ExportFileWriter):
+    """
+    Keeps a table's first row as its headers and spills the
+    rest to disk as the items of a JSON list, separated like json.dumps does
+    """
+
+    def _open(self):
+        self.encoder = JsonExportWriter.ConstantEncoder()
+        self.headers = None
+        self._has_rows = False
+
+    def write_row(self, row):
+        if self.headers is None:
+            self.headers = row
+            return
+        if self._has_rows:
+            self._file.write(', ')
+        self._file.write(self.encoder.encode(row))
+        self._has_rows = True
+
+
+class StreamingJsonExportWriter(OnDiskExportWriter):
+    """
+    Write tables to JSON like JsonExportWriter, without keeping their rows
+    in memory. The output is byte for byte what JsonExportWriter writes.
+    """
+    writer_class = JsonRowsFileWriter
+
+    def _write_rows(self, sheet_index, rows):
+        self.tables[sheet_index].write_rows([list(self.get_data(row)) for row in rows])
+
+    def _write_final_result(self):
+        encoder = JsonExportWriter.ConstantEncoder()
+        # JsonExportWriter dumps a dict of the tables by name, so write them
+        # in that dict's order (a later table replaces one of the same name)
+        indexes_by_name = {}
+        for index in self.tables:
+            indexes_by_name[self.table_names[index]] = index
+
+        self.file.write('{')
+        for i, name in enumerate(indexes_by_name):
+            table_writer = self.tables[indexes_by_name[name]]
+            if i:
+                self.file.write(', ')
+            self.file.write('%s: {' % _encode_json_key(encoder, name))
+            for j, key in enumerate({"headers": None, "rows": None}):
+                if j:
+                    self.file.write(', ')
+                if key == "headers":
+                    self.file.write('"headers": %s' % encoder.encode(table_writer.headers))
+                else:
+                    self.file.write('"rows": [')
+                    for chunk in iter(lambda: table_writer.get_file().read(64 * 1024), ''):
+                        self.file.write(chunk)
+                    self.file.write(']')
+            self.file.write('}')
+        self.file.write('}')
+
+
+def _encode_json_key(encoder, key):
+    # how json encodes a dict key, which isn't always how it encodes the value
+    return encoder.encode({key: 0})[1:-len(': 0}')]
+
+
+class NdjsonExportWriter(ExportWriter):
+    """
+    Write one JSON object per line for each row as it comes in:
+    {"table": <table name>, "row": {<header>: <value>, ...}}
+    """
+
+    def _init(self):
+        self.encoder = JsonExportWriter.ConstantEncoder()
+        self.table_names = {}
+        self.headers = {}
+
+    def _init_table(self, table_index, table_title):
+        self.table_names[table_index] = table_title
+
+    def _write_row(self, sheet_index, row):
+        row = self.get_data(row)
+        if sheet_index not in self.headers:
+            self.headers[sheet_index] = list(row)
+            return
+        self.file.write(self.encoder.encode(OrderedDict([
+            ('table', self.table_names[sheet_index]),
+            ('row', OrderedDict(zip(self.headers[sheet_index], row))),
+        ])))
+        self.file.write('\n')
+
+    def _close(self):
+        pass
+
+
 class HtmlExportWriter(OnDiskExportWriter):
     """
     Write tables to a single HTML file.
@@ -453,12 +1012,10 @@ class HtmlExportWriter(OnDiskExportWriter):
 
     def _write_final_result(self):
 
+        template = CompiledHtmlExportTemplate()
+
         def write(context):
-            self.file.write(
-                render_to_string(
-                    "couchexport/html_export.html", context
-                ).encode("utf-8")
-            )
+            self.file.write(template.render(context).encode("utf-8"))
 
         write({"section": "doc_begin"})
         for index, name in self.table_names.items():
@@ -479,3 +1036,319 @@ class ZippedHtmlExportWriter(ZippedExportWriter):
     writer_class = HtmlFileWriter
     table_file_extension = ".html"
 
+
+
+class ColumnBuffer(object):
+    """
+    A table's rows, buffered into columns until they're written out
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = None
+        self.columns = None
+        self.row_count = 0
+        self.size = 0
+        self.file_writer = None
+
+    def set_headers(self, headers):
+        self.headers = [h.decode('utf-8') if isinstance(h, str) else unicode(h) for h in headers]
+        self.clear()
+
+    def append(self, row):
+        size = 0
+        for column, value in itertools.izip_longest(self.columns, row[:len(self.columns)]):
+            if value is not None:
+                if isinstance(value, str):
+                    value = value.decode('utf-8')
+                elif not isinstance(value, unicode):
+                    value = unicode(value)
+                size += len(value)
+            column.append(value)
+        self.row_count += 1
+        self.size += size
+        return size
+
+    def clear(self):
+        self.columns = [[] for _ in self.headers]
+        self.row_count = 0
+        self.size = 0
+
+
+class ColumnarExportWriter(ExportWriter):
+    """
+    Writes each table to a columnar file, zipped up like ZippedExportWriter.
+
+    Rows are buffered into columns and written out in batches (row groups)
+    of up to `row_group_size` rows, or sooner once all the tables' buffers
+    take up more than about `max_buffer_size` bytes.
+
+    Every column is a nullable string column: the values in a
+    column can be of any type, and every batch needs the same schema.
+    """
+    table_file_extension = None
+    # how the table files are stored in the zip
+    zip_compression = zipfile.ZIP_DEFLATED
+
+    def __init__(self, row_group_size=None, max_buffer_size=None):
+        self.row_group_size = row_group_size or \
+            getattr(settings, 'COUCHEXPORT_COLUMNAR_ROW_GROUP_SIZE', 10000)
+        self.max_buffer_size = max_buffer_size or \
+            getattr(settings, 'COUCHEXPORT_COLUMNAR_MAX_BUFFER_SIZE', 64 * 1024 * 1024)
+
+    def _init(self):
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("It doesn't look like this machine is configured for "
+                            "columnar export. To export to parquet or arrow you have "
+                            "to run the command:  pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.tables = {}
+        self.table_names = {}
+        self.table_order = []
+        self.buffer_size = 0
+
+    def _init_table(self, table_index, table_title):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.tables[table_index] = ColumnBuffer(path)
+        self.table_names[table_index] = table_title
+        self.table_order.append(table_index)
+
+    def _write_row(self, sheet_index, row):
+        table = self.tables[sheet_index]
+        row = list(self.get_data(row))
+        if table.headers is None:
+            table.set_headers(row)
+            return
+        self.buffer_size += table.append(row)
+        if table.row_count >= self.row_group_size:
+            self._flush(table)
+        while self.buffer_size > self.max_buffer_size:
+            self._flush(max(self.tables.values(), key=lambda t: t.size))
+
+    def _flush(self, table):
+        pyarrow = self.pyarrow
+        if table.file_writer is None:
+            schema = pyarrow.schema([pyarrow.field(header, pyarrow.string())
+                                     for header in table.headers])
+            table.file_writer = self._open_table_file(table.path, schema)
+        if table.row_count:
+            batch = pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(column, type=pyarrow.string()) for column in table.columns],
+                table.headers
+            )
+            self._write_batch(table.file_writer, batch)
+        self.buffer_size -= table.size
+        table.clear()
+
+    def _open_table_file(self, path, schema):
+        raise NotImplementedError
+
+    def _write_batch(self, file_writer, batch):
+        raise NotImplementedError
+
+    def _close(self):
+        try:
+            for table in self.tables.values():
+                self._flush(table)
+                table.file_writer.close()
+
+            archive = zipfile.ZipFile(self.file, 'w', self.zip_compression, allowZip64=True)
+            for index in self.table_order:
+                name = self.table_names[index]
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                archive.write(self.tables[index].path, "{}{}".format(name, self.table_file_extension))
+            archive.close()
+            self.file.seek(0)
+        finally:
+            for table in self.tables.values():
+                if os.path.exists(table.path):
+                    os.remove(table.path)
+
+
+class ParquetExportWriter(ColumnarExportWriter):
+    """
+    Writer that creates a zip file containing a parquet file for each table.
+    """
+    table_file_extension = ".parquet"
+    # parquet compresses its column chunks itself
+    zip_compression = zipfile.ZIP_STORED
+
+    def _open_table_file(self, path, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(path, schema)
+
+    def _write_batch(self, file_writer, batch):
+        file_writer.write_table(self.pyarrow.Table.from_batches([batch]))
+
+
+class ArrowExportWriter(ColumnarExportWriter):
+    """
+    Writer that creates a zip file containing an arrow ipc file for each table.
+    """
+    table_file_extension = ".arrow"
+
+    def _open_table_file(self, path, schema):
+        return self.pyarrow.RecordBatchFileWriter(path, schema)
+
+    def _write_batch(self, file_writer, batch):
+        file_writer.write_batch(batch)
+
+
+def quote_sql_name(name):
+    return u'"%s"' % name.replace(u'"', u'""')
+
+
+class SqliteExportWriter(ExportWriter):
+    """
+    Writes each table to a table of a single SQLite database file.
+
+    Rows are inserted in batches of `batch_size` and the tables' id
+    columns (id, id__0, id__1, ...) are indexed once they are loaded,
+    so child tables can be joined to their parents.
+    """
+    id_column_pattern = re.compile(r'^id(__\d+)?$')
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or getattr(settings, 'COUCHEXPORT_SQLITE_BATCH_SIZE', 1000)
+
+    def _init(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        # the file is thrown away if the export doesn't finish
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.table_names = {}
+        self.headers = {}
+        self.buffers = {}
+        self.inserts = {}
+        # SQLite's names are case-insensitive
+        self._used_table_names = UniqueHeaderGenerator()
+
+    def _unique(self, generator, name):
+        unique = generator.next_unique(name.lower())
+        return name + unique[len(name):]
+
+    def _init_table(self, table_index, table_title):
+        self.table_names[table_index] = self._unique(self._used_table_names, table_title)
+
+    def _create_table(self, table_index, headers):
+        column_names = UniqueHeaderGenerator()
+        headers = [self._unique(column_names, header.decode('utf-8') if isinstance(header, str)
+                                else unicode(header))
+                   for header in headers]
+        table = quote_sql_name(self.table_names[table_index])
+        # ids are stored as text so the formatted ids ("0") can be joined
+        # to the parts of the compound ids (0) in the child tables
+        columns = [quote_sql_name(header) + (u" TEXT" if self.id_column_pattern.match(header) else u"")
+                   for header in headers]
+        self.db.execute(u"CREATE TABLE %s (%s)" % (table, u", ".join(columns)))
+        self.headers[table_index] = headers
+        self.buffers[table_index] = []
+        self.inserts[table_index] = u"INSERT INTO %s VALUES (%s)" % (
+            table, u", ".join([u"?"] * len(headers)))
+
+    def _write_row(self, sheet_index, row):
+        try:
+            self._write_sql_row(sheet_index, row)
+        except Exception:
+            # the export won't finish, so don't leave the database behind
+            self._discard()
+            raise
+
+    def _write_sql_row(self, sheet_index, row):
+        row = list(self.get_data(row))
+        if sheet_index not in self.headers:
+            self._create_table(sheet_index, row)
+            return
+
+        def _sql_value(value):
+            if value is None or isinstance(value, (int, long, float, unicode)):
+                return value
+            if isinstance(value, str):
+                return value.decode('utf-8')
+            return unicode(value)
+
+        width = len(self.headers[sheet_index])
+        row = map(_sql_value, row[:width]) + [None] * (width - len(row))
+        buffer = self.buffers[sheet_index]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self._flush(sheet_index)
+
+    def _flush(self, table_index):
+        self.db.executemany(self.inserts[table_index], self.buffers[table_index])
+        self.buffers[table_index] = []
+
+    def _discard(self):
+        self.db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _close(self):
+        try:
+            for table_index in self.headers:
+                self._flush(table_index)
+                table_name = self.table_names[table_index]
+                for header in self.headers[table_index]:
+                    if self.id_column_pattern.match(header):
+                        self.db.execute(u"CREATE INDEX %s ON %s (%s)" % (
+                            quote_sql_name(u"ix_%s_%s" % (table_name, header)),
+                            quote_sql_name(table_name),
+                            quote_sql_name(header),
+                        ))
+            self.db.commit()
+            self.db.close()
+            with open(self.path, 'rb') as f:
+                shutil.copyfileobj(f, self.file)
+            self.file.seek(0)
+        finally:
+            self._discard()
+
+
+class TeeExportWriter(ExportWriter):
+    """
+    Writes the same export with several writers at once, e.g. to get it
+    in more than one format from a single pass over the docs.
+
+    open() takes a file for each writer.
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def open(self, header_table, files, max_column_size=2000, table_titles=None):
+        # headers and rows are shared by the writers so they can't be one-shot iterators
+        header_table = [(table_index, list(table)) for table_index, table in header_table]
+        assert len(files) == len(self.writers)
+        for writer, file in zip(self.writers, files):
+            writer.open(header_table, file, max_column_size=max_column_size,
+                        table_titles=table_titles)
+        self._isopen = True
+
+    def add_table(self, table_index, headers, table_title=None):
+        for writer in self.writers:
+            writer.add_table(table_index, headers, table_title=table_title)
+
+    def write(self, document_table, skip_first=False):
+        assert self._isopen
+        document_table = [(table_index, list(table)) for table_index, table in document_table]
+        for writer in self.writers:
+            writer.write(document_table, skip_first=skip_first)
+
+    def write_row(self, table_index, row):
+        for writer in self.writers:
+            writer.write_row(table_index, row)
+
+    def write_rows(self, table_index, rows):
+        rows = list(rows)
+        for writer in self.writers:
+            writer.write_rows(table_index, rows)
+
+    def _close(self):
+        for writer in self.writers:
+            writer.close()
@@ -19,6 +19,10 @@ setup(
         "unidecode",
         "xlwt",
     ],
+    extras_require={
+        # for the parquet and arrow formats
+        'columnar': ["pyarrow"],
+    },
     packages=find_packages(exclude=['*.pyc']),
     include_package_data=True,
     dependency_links=[